@@ -3,15 +3,21 @@ import json
 import re
 import time
 import asyncio
-from typing import Dict, List, Tuple, Optional
+import hashlib
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Tuple, Optional, Union
+import logging
 import httpx
+import orjson
 from dotenv import load_dotenv
 
 from models import StoryConfig, StoryParagraph, StoryChoice, StoryResponse
+from story_store import load_story, save_story, remove_story, redis_client
 from prompts import (
     get_system_prompt, 
     create_story_init_prompt, 
     create_continuation_prompt,
+    create_custom_continuation_prompt,
     create_title_prompt,
     get_story_length_instructions
 )
@@ -19,14 +25,96 @@ from prompts import (
 # تحميل المتغيرات البيئية
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # الحصول على مفتاح API من المتغيرات البيئية
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 
-# تخزين سياق القصص
-# في نظام حقيقي، يجب استخدام قاعدة بيانات بدلاً من التخزين في الذاكرة
-stories_context = {}
-stories_metadata = {}
+# الحد الأقصى لمدة كل محاولة اتصال بالثواني (مهلة httpx الأعلى تبقى حماية ثانوية)
+REQUEST_ATTEMPT_TIMEOUT = float(os.getenv("REQUEST_ATTEMPT_TIMEOUT", "45"))
+
+# برومبت النظام ثابت، فنحسبه مرة واحدة عند التحميل
+SYSTEM_PROMPT = get_system_prompt()
+
+# عناوين أقسام استجابة النموذج والتعابير النمطية الاحتياطية (مُجمّعة مرة واحدة عند التحميل)
+_PARAGRAPH_HEADER = "الفقرة:"
+_CHOICES_HEADER = "الخيارات:"
+_TITLE_HEADER = "العنوان:"
+_NUMBERED_CHOICE_RE = re.compile(r"\d+\.\s*(.*?)(?=\d+\.|$)", re.DOTALL)
+_LEADING_NUM_RE = re.compile(r"^\d+\.\s*")
+_NEW_TITLE_RE = re.compile(r"العنوان الجديد:\s*(.*?)(?:\n|$)", re.IGNORECASE)
+
+# ذاكرة تخزين مؤقت لاستجابات النموذج (LRU) لتجنب استدعاء API لنفس المحادثة مرتين
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+# مدة بقاء الاستجابات في Redis عند استخدامه كطبقة مشتركة بين العمليات
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", str(24 * 3600)))
+_response_cache: "OrderedDict[str, str]" = OrderedDict()
+
+# عدد الجولات السابقة (رد النموذج + رسالة المستخدم) المرسلة مع كل طلب متابعة
+# برومبت المتابعة يحتوي على نص القصة كاملاً، لذا لا حاجة لإعادة إرسال المحادثة بأكملها
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", "2"))
+
+# الطبقة الدلالية اختيارية وتعمل فقط لبدايات القصص عند تفعيلها
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+# مفتاح الاستجابة -> (الطول والنوع الأساسي، المتجه الدلالي)
+_semantic_index: "OrderedDict[str, Tuple[Tuple[str, str], object]]" = OrderedDict()
+_embedder = None
+
+# مهام توليد العناوين الجارية في الخلفية لكل قصة
+# (تُحفظ خارج معلومات القصة لأن المهام ليست بيانات قابلة للحفظ)
+_title_tasks: Dict[str, asyncio.Task] = {}
+
+# عميل HTTP مشترك يعيد استخدام الاتصالات (keep-alive و HTTP/2) بين الطلبات والمحاولات
+# يُنشأ عند تشغيل الخادم ويُتاح أيضاً عبر app.state.http
+_client: Optional[httpx.AsyncClient] = None
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "50"))
+
+
+async def get_client() -> httpx.AsyncClient:
+    """
+    الحصول على عميل HTTP المشترك وإنشاؤه عند أول استخدام
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            headers={
+                "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+            http2=True
+        )
+    return _client
+
+
+async def close_client() -> None:
+    """
+    إغلاق عميل HTTP المشترك عند إيقاف الخادم
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _build_payload(messages: List[Dict], stream: bool = False) -> Dict:
+    """
+    إنشاء جسم طلب DeepSeek API
+    """
+    payload = {
+        "model": "deepseek-chat",  # استبدل باسم النموذج المناسب من DeepSeek API
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": 1000
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
 
 
 async def generate_response(messages: List[Dict], retries=3, backoff_factor=1.5) -> str:
@@ -47,57 +135,57 @@ async def generate_response(messages: List[Dict], retries=3, backoff_factor=1.5)
     if not DEEPSEEK_API_KEY:
         raise Exception("مفتاح API غير متوفر. يرجى التحقق من إعداد المتغيرات البيئية.")
         
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-    }
-    
-    payload = {
-        "model": "deepseek-chat",  # استبدل باسم النموذج المناسب من DeepSeek API
-        "messages": messages,
-        "temperature": 0.7,
-        "max_tokens": 1000
-    }
+    # ترميز الطلب مرة واحدة خارج حلقة إعادة المحاولة
+    body = orjson.dumps(_build_payload(messages))
     
     last_exception = None
     
     # محاولات إعادة الاتصال في حالة فشل API
     for attempt in range(retries):
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    DEEPSEEK_API_URL,
-                    headers=headers,
-                    json=payload,
-                    timeout=60.0
-                )
-                
-                if response.status_code == 429:  # Rate Limit
-                    # انتظار فترة قبل المحاولة مرة أخرى
-                    wait_time = backoff_factor * (2 ** attempt)
-                    print(f"تجاوز حد معدل الطلبات، انتظار {wait_time} ثانية قبل المحاولة مرة أخرى.")
-                    await asyncio.sleep(wait_time)
-                    continue
-                
-                if response.status_code != 200:
-                    error_msg = f"فشل طلب DeepSeek API: {response.status_code} - {response.text}"
-                    print(error_msg)
-                    last_exception = Exception(error_msg)
-                    
-                    # انتظار فترة قبل المحاولة مرة أخرى
-                    wait_time = backoff_factor * (2 ** attempt)
-                    await asyncio.sleep(wait_time)
-                    continue
+            client = await get_client()
+            # مهلة على مستوى المهمة تلغي المحاولة العالقة حتى لو لم تنتهِ مهلة httpx
+            response = await asyncio.wait_for(
+                client.post(DEEPSEEK_API_URL, content=body),
+                timeout=REQUEST_ATTEMPT_TIMEOUT
+            )
+            
+            if response.status_code == 429:  # Rate Limit
+                # انتظار فترة قبل المحاولة مرة أخرى
+                wait_time = backoff_factor * (2 ** attempt)
+                logger.warning("تجاوز حد معدل الطلبات، انتظار %s ثانية قبل المحاولة مرة أخرى.", wait_time)
+                await asyncio.sleep(wait_time)
+                continue
+            
+            if response.status_code != 200:
+                error_msg = f"فشل طلب DeepSeek API: {response.status_code} - {response.text}"
+                logger.warning(error_msg)
+                last_exception = Exception(error_msg)
                 
-                result = response.json()
-                if "choices" not in result or not result["choices"]:
-                    raise Exception("تنسيق استجابة DeepSeek API غير صالح")
-                    
-                return result["choices"][0]["message"]["content"]
+                # انتظار فترة قبل المحاولة مرة أخرى
+                wait_time = backoff_factor * (2 ** attempt)
+                await asyncio.sleep(wait_time)
+                continue
+            
+            result = orjson.loads(response.content)
+            if "choices" not in result or not result["choices"]:
+                raise Exception("تنسيق استجابة DeepSeek API غير صالح")
                 
+            return result["choices"][0]["message"]["content"]
+            
+        except asyncio.TimeoutError:
+            error_msg = f"انتهت مهلة طلب DeepSeek API بعد {REQUEST_ATTEMPT_TIMEOUT} ثانية"
+            logger.warning(error_msg)
+            last_exception = Exception(error_msg)
+            
+            # انتظار فترة قبل المحاولة مرة أخرى
+            wait_time = backoff_factor * (2 ** attempt)
+            await asyncio.sleep(wait_time)
+            continue
+            
         except httpx.HTTPError as e:
             error_msg = f"خطأ في اتصال HTTP: {str(e)}"
-            print(error_msg)
+            logger.warning(error_msg)
             last_exception = Exception(error_msg)
             
             # انتظار فترة قبل المحاولة مرة أخرى
@@ -107,7 +195,7 @@ async def generate_response(messages: List[Dict], retries=3, backoff_factor=1.5)
             
         except Exception as e:
             error_msg = f"خطأ غير متوقع: {str(e)}"
-            print(error_msg)
+            logger.warning(error_msg)
             last_exception = Exception(error_msg)
             
             # انتظار فترة قبل المحاولة مرة أخرى
@@ -119,89 +207,344 @@ async def generate_response(messages: List[Dict], retries=3, backoff_factor=1.5)
     raise last_exception or Exception("فشل الاتصال بـ DeepSeek API بعد عدة محاولات")
 
 
-def parse_paragraph_and_choices(response_text: str) -> Tuple[str, Optional[List[StoryChoice]]]:
+async def generate_response_stream(messages: List[Dict]) -> AsyncIterator[str]:
     """
-    تحليل استجابة النموذج واستخراج الفقرة والخيارات
+    استدعاء DeepSeek API بوضع البث وإرجاع أجزاء الاستجابة فور وصولها
+    
+    لا تتم إعادة المحاولة هنا لأن الأجزاء قد تكون أُرسلت للعميل بالفعل
+    
+    Args:
+        messages: قائمة برسائل المحادثة
+        
+    Yields:
+        str: جزء جديد من محتوى الاستجابة
     """
-    # محاولة استخراج الفقرة
-    paragraph_match = re.search(r"الفقرة:(.*?)(?:الخيارات:|العنوان:|$)", response_text, re.DOTALL)
-    paragraph = paragraph_match.group(1).strip() if paragraph_match else response_text.strip()
+    if not DEEPSEEK_API_KEY:
+        raise Exception("مفتاح API غير متوفر. يرجى التحقق من إعداد المتغيرات البيئية.")
     
-    # محاولة استخراج الخيارات
-    choices = None
-    choices_match = re.search(r"الخيارات:(.*?)(?:$)", response_text, re.DOTALL)
+    client = await get_client()
+    body = orjson.dumps(_build_payload(messages, stream=True))
+    async with client.stream("POST", DEEPSEEK_API_URL, content=body) as response:
+        if response.status_code != 200:
+            await response.aread()
+            raise Exception(f"فشل طلب DeepSeek API: {response.status_code} - {response.text}")
+        
+        # الاستجابة بتنسيق Server-Sent Events: سطر "data: {...}" لكل جزء
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            
+            chunk = orjson.loads(data)
+            if not chunk.get("choices"):
+                continue
+            content = chunk["choices"][0].get("delta", {}).get("content")
+            if content:
+                yield content
+
+
+def _cache_key(messages: List[Dict]) -> str:
+    """
+    حساب مفتاح التخزين المؤقت لسلسلة الرسائل
+    """
+    # تغذية الدالة بالدور والمحتوى مباشرة بدلاً من إعادة تسلسل المحادثة كاملة إلى JSON
+    digest = hashlib.blake2b(digest_size=16)
+    for message in messages:
+        digest.update(message["role"].encode())
+        digest.update(b"\x00")
+        digest.update(message["content"].encode())
+        digest.update(b"\x01")
+    return digest.hexdigest()
+
+
+def _embed(text: str):
+    """
+    حساب المتجه الدلالي (المُطبّع) لنص باستخدام نموذج التضمين المحلي
+    """
+    global _embedder
+    if _embedder is None:
+        from sentence_transformers import SentenceTransformer
+        _embedder = SentenceTransformer(SEMANTIC_CACHE_MODEL)
+    return _embedder.encode(text, normalize_embeddings=True)
+
+
+def _semantic_text(config: StoryConfig) -> str:
+    """
+    تمثيل قصير وثابت لإعدادات القصة يُحسب منه المتجه الدلالي
+    
+    نستخدم الإعدادات بدلاً من البرومبت الكامل لأن تعليماته الثابتة تطغى على التشابه
+    وتتجاوز حد طول الإدخال في نموذج التضمين
+    """
+    characters = "; ".join(
+        f"{c.name} ({c.gender.value}): {c.description}" for c in config.characters
+    )
+    return f"{config.length.value} | {config.primary_type.value} | {config.secondary_type.value} | {characters}"
+
+
+def _semantic_group(config: StoryConfig) -> Tuple[str, str]:
+    """
+    الحقول التي يجب أن تتطابق تماماً قبل قبول أي تطابق دلالي
+    """
+    return config.length.value, config.primary_type.value
+
+
+def _semantic_lookup(group: Tuple[str, str], embedding) -> Optional[str]:
+    """
+    البحث عن أقرب استجابة مخزنة دلالياً فوق عتبة التشابه لقصص بنفس الطول والنوع
+    """
+    best_key, best_score = None, SEMANTIC_CACHE_THRESHOLD
+    for key, (cached_group, cached_embedding) in _semantic_index.items():
+        if cached_group != group:
+            continue
+        score = float(embedding @ cached_embedding)
+        if score >= best_score:
+            best_key, best_score = key, score
+    
+    if best_key is None or best_key not in _response_cache:
+        return None
+    
+    _response_cache.move_to_end(best_key)
+    return _response_cache[best_key]
+
+
+async def _cache_lookup(key: str) -> Optional[str]:
+    """
+    البحث عن استجابة مطابقة تماماً في الذاكرة المحلية ثم في Redis إن وُجد
+    """
+    if key in _response_cache:
+        _response_cache.move_to_end(key)
+        return _response_cache[key]
+    
+    if redis_client is None:
+        return None
+    
+    cached = await redis_client.get(f"llm:{key}")
+    if cached is None:
+        return None
+    
+    # نسخة محلية حتى لا نعود إلى Redis للمفتاح نفسه
+    response_text = cached.decode()
+    _cache_store(key, response_text)
+    return response_text
+
+
+async def _cache_save(key: str, response_text: str, semantic_entry=None) -> None:
+    """
+    حفظ استجابة جديدة محلياً وفي Redis (مشتركة بين العمليات) إن وُجد
+    """
+    _cache_store(key, response_text, semantic_entry)
+    if redis_client is not None:
+        await redis_client.set(f"llm:{key}", response_text, ex=RESPONSE_CACHE_TTL_SECONDS)
+
+
+def _cache_store(key: str, response_text: str, semantic_entry=None) -> None:
+    """
+    حفظ استجابة في الذاكرة المؤقتة المحلية مع إزالة الأقدم عند تجاوز الحد
+    """
+    _response_cache[key] = response_text
+    _response_cache.move_to_end(key)
+    if semantic_entry is not None:
+        _semantic_index[key] = semantic_entry
+    
+    while len(_response_cache) > RESPONSE_CACHE_SIZE:
+        evicted_key, _ = _response_cache.popitem(last=False)
+        _semantic_index.pop(evicted_key, None)
+
+
+async def cached_generate(messages: List[Dict], semantic_config: Optional[StoryConfig] = None) -> str:
+    """
+    توليد استجابة مع المرور أولاً بالذاكرة المؤقتة
+    
+    Args:
+        messages: قائمة برسائل المحادثة
+        semantic_config: إعدادات القصة للسماح بالمطابقة الدلالية (لبدايات القصص فقط)
+        
+    Returns:
+        str: محتوى الاستجابة من الذاكرة المؤقتة أو من API
+    """
+    key = _cache_key(messages)
+    cached = await _cache_lookup(key)
+    if cached is not None:
+        return cached
+    
+    semantic_entry = None
+    if semantic_config is not None and SEMANTIC_CACHE_ENABLED:
+        # حساب التضمين عمل مكثف للمعالج فننفذه خارج حلقة الأحداث
+        group = _semantic_group(semantic_config)
+        embedding = await asyncio.to_thread(_embed, _semantic_text(semantic_config))
+        cached = _semantic_lookup(group, embedding)
+        if cached is not None:
+            return cached
+        semantic_entry = (group, embedding)
+    
+    response_text = await generate_response(messages)
+    await _cache_save(key, response_text, semantic_entry)
+    return response_text
+
+
+def _split_numbered_choices(choices_text: str) -> List[str]:
+    """
+    تقسيم كتلة الخيارات المرقمة إلى نصوص الخيارات بمؤشرين في مرور واحد
     
-    if choices_match:
-        choices_text = choices_match.group(1).strip()
-        choices = []
+    علامة الترقيم هي أرقام متبوعة بنقطة في بداية النص أو بعد مسافة، سواء كانت
+    الخيارات في أسطر منفصلة أو في سطر واحد
+    """
+    choices = []
+    text_end = len(choices_text)
+    current_start = -1
+    i = 0
+    
+    while i < text_end:
+        if not choices_text[i].isdigit() or (i > 0 and not choices_text[i - 1].isspace()):
+            i += 1
+            continue
         
-        # استخراج الخيارات المرقمة
-        for i, choice_match in enumerate(re.findall(r"\d+\.\s*(.*?)(?=\d+\.|$)", choices_text, re.DOTALL), 1):
-            choice_text = choice_match.strip()
-            if choice_text:
-                choices.append(StoryChoice(id=i, text=choice_text))
+        # تقديم المؤشر الثاني حتى نهاية الأرقام
+        j = i
+        while j < text_end and choices_text[j].isdigit():
+            j += 1
         
-        # إذا لم يتم العثور على خيارات بالطريقة السابقة، نحاول طريقة أخرى
-        if not choices:
-            lines = choices_text.split("\n")
-            for i, line in enumerate([l for l in lines if l.strip()], 1):
-                if i <= 3:  # نقتصر على 3 خيارات
-                    # تجاهل الترقيم إذا كان موجوداً
-                    choice_text = re.sub(r"^\d+\.\s*", "", line).strip()
-                    choices.append(StoryChoice(id=i, text=choice_text))
+        if j < text_end and choices_text[j] == ".":
+            if current_start != -1:
+                choices.append(" ".join(choices_text[current_start:i].split()))
+            current_start = j + 1
+        i = j + 1
+    
+    if current_start != -1:
+        choices.append(" ".join(choices_text[current_start:].split()))
+    
+    return choices
+
+
+def parse_paragraph_and_choices(response_text: str) -> Tuple[str, Optional[List[Tuple[int, str]]], Optional[str]]:
+    """
+    تحليل استجابة النموذج واستخراج الفقرة والخيارات والعنوان
+    
+    تُرجع الخيارات كأزواج (المعرف، النص) دون إنشاء نماذج Pydantic، ويتم إنشاؤها
+    عند بناء الاستجابة فقط
+    """
+    # تحديد مواضع الأقسام بالترتيب، فيبدأ بحث كل قسم من حيث انتهى القسم السابق
+    # وبذلك يُمسح النص مرة واحدة تقريباً، ويُتخطى أي قسم غير موجود
+    text_end = len(response_text)
+    paragraph_start = response_text.find(_PARAGRAPH_HEADER)
+    search_from = paragraph_start + len(_PARAGRAPH_HEADER) if paragraph_start != -1 else 0
+    choices_start = response_text.find(_CHOICES_HEADER, search_from)
+    if choices_start != -1:
+        search_from = choices_start + len(_CHOICES_HEADER)
+    title_start = response_text.find(_TITLE_HEADER, search_from)
+    
+    # استخراج الفقرة حتى أول قسم يليها
+    if paragraph_start != -1:
+        body_start = paragraph_start + len(_PARAGRAPH_HEADER)
+        paragraph_end = next((i for i in (choices_start, title_start) if i != -1), text_end)
+        paragraph = response_text[body_start:paragraph_end].strip()
+    else:
+        paragraph = response_text.strip()
+    
+    # استخراج الخيارات (فقط إذا كانت الاستجابة تحتوي على قسم الخيارات)
+    choices = None
+    if choices_start != -1:
+        body_start = choices_start + len(_CHOICES_HEADER)
+        choices_end = title_start if title_start != -1 else text_end
+        choices_text = response_text[body_start:choices_end].strip()
+        
+        # نقتصر على 3 خيارات كما يطلب البرومبت
+        choice_texts = [t for t in _split_numbered_choices(choices_text) if t][:3]
+        
+        # التعابير النمطية احتياطية فقط إذا لم يُعثر على أي خيار مرقم
+        if not choice_texts:
+            choice_texts = [t.strip() for t in _NUMBERED_CHOICE_RE.findall(choices_text) if t.strip()][:3]
+        if not choice_texts:
+            # تجاهل الترقيم إذا كان موجوداً ونقتصر على 3 خيارات
+            lines = [l for l in choices_text.splitlines() if l.strip()][:3]
+            choice_texts = [_LEADING_NUM_RE.sub("", line).strip() for line in lines]
+        
+        choices = list(enumerate(choice_texts, 1))
     
     # استخراج العنوان إذا كان موجوداً
     title = None
-    title_match = re.search(r"العنوان:(.*?)(?:$)", response_text, re.DOTALL)
-    if title_match:
-        title = title_match.group(1).strip()
+    if title_start != -1:
+        title = response_text[title_start + len(_TITLE_HEADER):].strip()
     
     return paragraph, choices, title
 
 
-async def initialize_story(config: StoryConfig) -> StoryResponse:
+def _build_choices(choices: Optional[List[Tuple[int, str]]]) -> Optional[List[StoryChoice]]:
     """
-    بدء قصة جديدة باستخدام DeepSeek API
+    إنشاء نماذج الخيارات للاستجابة دون إعادة التحقق من بيانات أنشأها المحلل
     """
-    import uuid
-    story_id = str(uuid.uuid4())
-    
-    # إنشاء البرومبت الأولي
-    system_prompt = get_system_prompt()
-    user_prompt = create_story_init_prompt(config)
+    if not choices:
+        return None
+    return [StoryChoice.model_construct(id=choice_id, text=text) for choice_id, text in choices]
+
+
+def _normalize_config(config: StoryConfig) -> StoryConfig:
+    """
+    توحيد المسافات في نصوص الشخصيات حتى تتطابق الطلبات المتماثلة في الذاكرة المؤقتة
+    """
+    characters = [
+        character.model_copy(update={
+            "name": " ".join(character.name.split()),
+            "description": " ".join(character.description.split())
+        })
+        for character in config.characters
+    ]
+    return config.model_copy(update={"characters": characters})
+
+
+def _create_init_messages(config: StoryConfig) -> List[Dict]:
+    """
+    إنشاء رسائل المحادثة الأولية لبدء قصة جديدة
+    """
+    system_prompt = SYSTEM_PROMPT
+    user_prompt = create_story_init_prompt(_normalize_config(config))
     
-    messages = [
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt}
     ]
-    
-    # استدعاء DeepSeek API
-    response_text = await generate_response(messages)
+
+
+async def _store_new_story(config: StoryConfig, messages: List[Dict], response_text: str) -> StoryResponse:
+    """
+    تحليل الاستجابة الأولى وحفظ القصة الجديدة وإنشاء استجابتها
+    """
+    import uuid
+    story_id = uuid.uuid4().hex
     
     # تحليل الاستجابة
+    # التحليل يتم مباشرة في حلقة الأحداث: الاستجابة محدودة بـ max_tokens=1000 (بضعة آلاف حرف)
+    # فيستغرق تحليلها أجزاء من الملي ثانية، أقل من كلفة الانتقال إلى خيط منفصل
     paragraph_text, choices, _ = parse_paragraph_and_choices(response_text)
     
     # إنشاء فقرة القصة
     paragraph = StoryParagraph(
         content=paragraph_text,
-        choices=choices
+        choices=_build_choices(choices)
     )
     
-    # حفظ سياق القصة
-    stories_context[story_id] = {
+    # سياق القصة
+    context = {
         "paragraphs": [paragraph_text],
+        "joined": paragraph_text,  # نص السياق المتراكم لتجنب إعادة الدمج في كل دورة
         "current_paragraph": 1
     }
     
-    # حفظ معلومات القصة
+    # معلومات القصة
     length_info = get_story_length_instructions(config.length)
-    stories_metadata[story_id] = {
-        "config": config.dict(),
+    metadata = {
+        "length": config.length.value,  # لا نحتاج من التكوين إلا الطول بعد بدء القصة
         "max_paragraphs": length_info["paragraphs"],
         "messages": messages + [{"role": "assistant", "content": response_text}],
+        "last_choices": dict(choices or []),
         "title": None
     }
     
+    # حفظ القصة
+    await save_story(story_id, context, metadata)
+    
     # إنشاء استجابة القصة
     story_response = StoryResponse(
         story_id=story_id,
@@ -212,54 +555,110 @@ async def initialize_story(config: StoryConfig) -> StoryResponse:
     return story_response
 
 
-async def continue_story(story_id: str, choice_id: int) -> StoryResponse:
+async def _get_story_state(story_id: str) -> Tuple[Dict, Dict]:
     """
-    متابعة القصة بناءً على اختيار المستخدم
+    الحصول على سياق القصة ومعلوماتها أو رفع خطأ إذا لم تكن موجودة
     """
-    if story_id not in stories_context or story_id not in stories_metadata:
+    state = await load_story(story_id)
+    if state is None:
         raise ValueError("معرف القصة غير صالح")
     
-    context = stories_context[story_id]
-    metadata = stories_metadata[story_id]
+    return state
+
+
+def _trim_history(messages: List[Dict]) -> List[Dict]:
+    """
+    اقتطاع المحادثة إلى رسالة النظام والبرومبت الأولي وآخر الجولات فقط
+    """
+    keep = 2 * HISTORY_KEEP_TURNS
+    if len(messages) <= 2 + keep:
+        return messages
     
-    # الحصول على سياق القصة والاختيار
-    paragraphs = context["paragraphs"]
-    current_paragraph = context["current_paragraph"]
-    max_paragraphs = metadata["max_paragraphs"]
+    # البرومبت الأولي يحمل معلومات الشخصيات ونوع القصة ويبقى بادئة ثابتة
+    return messages[:2] + messages[-keep:]
+
+
+async def _prepare_choice_turn(story_id: str, choice_id: int) -> Tuple[Dict, Dict, Dict, List[Dict]]:
+    """
+    إنشاء رسالة المتابعة بناءً على اختيار المستخدم
+    
+    Returns:
+        سياق القصة ومعلوماتها ورسالة المستخدم الجديدة والرسائل المقتطعة المرسلة للنموذج
+    """
+    context, metadata = await _get_story_state(story_id)
     
     # الحصول على الرسائل السابقة
     messages = metadata["messages"]
     
-    # الحصول على نص الاختيار
-    last_message = messages[-1]["content"]
-    _, choices, _ = parse_paragraph_and_choices(last_message)
+    # الحصول على نص الاختيار من الخيارات المحفوظة عند تحليل الاستجابة السابقة
+    choice_text = metadata["last_choices"].get(choice_id)
     
-    if not choices or choice_id < 1 or choice_id > len(choices):
+    if choice_text is None:
         raise ValueError("معرف الاختيار غير صالح")
     
-    choice_text = next((c.text for c in choices if c.id == choice_id), "")
-    
     # إنشاء برومبت المتابعة
-    story_context_text = "\n".join(paragraphs)
+    story_context_text = context["joined"]
     continuation_prompt = create_continuation_prompt(
         story_context_text, 
         choice_id, 
         choice_text, 
-        current_paragraph, 
+        context["current_paragraph"], 
+        metadata["max_paragraphs"]
+    )
+    
+    # لا نضيف رسالة المستخدم إلى المحادثة المحفوظة قبل نجاح التوليد
+    # حتى لا يبقى دور معلق إذا فشل الطلب أو انقطع البث
+    user_message = {"role": "user", "content": continuation_prompt}
+    
+    return context, metadata, user_message, _trim_history(messages + [user_message])
+
+
+async def _prepare_custom_turn(story_id: str, custom_text: str) -> Tuple[Dict, Dict, Dict, List[Dict]]:
+    """
+    إنشاء رسالة المتابعة بالنص المخصص
+    
+    Returns:
+        سياق القصة ومعلوماتها ورسالة المستخدم الجديدة والرسائل المقتطعة المرسلة للنموذج
+    """
+    context, metadata = await _get_story_state(story_id)
+    
+    # الحصول على سياق القصة
+    current_paragraph = context["current_paragraph"]
+    max_paragraphs = metadata["max_paragraphs"]
+    
+    # الحصول على الرسائل السابقة
+    messages = metadata["messages"]
+    
+    # إنشاء برومبت المتابعة بالنص المخصص
+    story_context_text = context["joined"]
+    custom_prompt = create_custom_continuation_prompt(
+        story_context_text,
+        custom_text,
+        current_paragraph,
         max_paragraphs
     )
     
-    # إضافة رسالة المستخدم
-    messages.append({"role": "user", "content": continuation_prompt})
+    # لا نضيف رسالة المستخدم إلى المحادثة المحفوظة قبل نجاح التوليد
+    user_message = {"role": "user", "content": custom_prompt}
     
-    # استدعاء DeepSeek API
-    response_text = await generate_response(messages)
+    return context, metadata, user_message, _trim_history(messages + [user_message])
+
+
+async def _complete_turn(story_id: str, context: Dict, metadata: Dict, user_message: Dict, response_text: str) -> StoryResponse:
+    """
+    تحليل استجابة المتابعة وتحديث سياق القصة وإنشاء استجابتها
+    """
+    paragraphs = context["paragraphs"]
+    current_paragraph = context["current_paragraph"]
+    max_paragraphs = metadata["max_paragraphs"]
+    messages = metadata["messages"]
     
     # تحليل الاستجابة
     paragraph_text, choices, title = parse_paragraph_and_choices(response_text)
     
     # تحديث سياق القصة
     paragraphs.append(paragraph_text)
+    context["joined"] = context["joined"] + "\n" + paragraph_text
     context["current_paragraph"] += 1
     context["paragraphs"] = paragraphs
     
@@ -270,14 +669,28 @@ async def continue_story(story_id: str, choice_id: int) -> StoryResponse:
     if is_complete and title:
         metadata["title"] = title
     
-    # تحديث الرسائل
+    # تحديث الرسائل بالجولة كاملة بعد نجاحها
+    messages.append(user_message)
     messages.append({"role": "assistant", "content": response_text})
     metadata["messages"] = messages
     
+    # حفظ الخيارات المعروضة للمستخدم حتى لا نعيد تحليل الاستجابة في الدورة التالية
+    if is_complete:
+        choices = None
+    metadata["last_choices"] = dict(choices or [])
+    
+    # إعادة الحفظ لتجديد مدة صلاحية القصة النشطة
+    await save_story(story_id, context, metadata)
+    
+    # إذا لم يقترح النموذج عنواناً، نبدأ توليده في الخلفية دون تأخير الفقرة الأخيرة
+    # (بعد الحفظ حتى تقرأ مهمة العنوان القصة كاملة بفقرتها الأخيرة)
+    if is_complete and not metadata["title"]:
+        _schedule_title_generation(story_id)
+    
     # إنشاء فقرة القصة
     paragraph = StoryParagraph(
         content=paragraph_text,
-        choices=None if is_complete else choices
+        choices=_build_choices(choices)
     )
     
     # إنشاء استجابة القصة
@@ -291,121 +704,108 @@ async def continue_story(story_id: str, choice_id: int) -> StoryResponse:
     return story_response
 
 
-async def continue_story_with_text(story_id: str, custom_text: str) -> StoryResponse:
+async def initialize_story(config: StoryConfig) -> StoryResponse:
     """
-    متابعة القصة بناءً على النص المخصص الذي أدخله المستخدم
+    بدء قصة جديدة باستخدام DeepSeek API
     """
-    print(f"continue_story_with_text called with story_id={story_id}, custom_text={custom_text}")
-    
-    if story_id not in stories_context or story_id not in stories_metadata:
-        print(f"Story ID {story_id} not found in context or metadata")
-        raise ValueError("معرف القصة غير صالح")
-    
-    context = stories_context[story_id]
-    metadata = stories_metadata[story_id]
-    
-    # الحصول على سياق القصة
-    paragraphs = context["paragraphs"]
-    current_paragraph = context["current_paragraph"]
-    max_paragraphs = metadata["max_paragraphs"]
-    
-    print(f"Story context: current_paragraph={current_paragraph}, max_paragraphs={max_paragraphs}")
+    messages = _create_init_messages(config)
     
-    # الحصول على الرسائل السابقة
-    messages = metadata["messages"]
-    
-    # إنشاء برومبت المتابعة بالنص المخصص
-    story_context_text = "\n".join(paragraphs)
+    # استدعاء DeepSeek API
+    response_text = await cached_generate(messages, semantic_config=_normalize_config(config))
     
-    # Create a prompt for continuing with custom text
-    custom_prompt = f"""
-لقد وصلنا إلى هذه النقطة في القصة:
+    return await _store_new_story(config, messages, response_text)
 
-{story_context_text}
 
-المستخدم اختار أن يكتب رداً مخصصاً بدلاً من اختيار أحد الخيارات المقدمة. الرد المخصص للمستخدم هو:
-
-"{custom_text}"
-
-بناءً على هذا المدخل من المستخدم، استمر في القصة واكتب فقرة جديدة تأخذ بعين الاعتبار ما كتبه المستخدم.
-ثم قدم 3 خيارات جديدة للمستخدم ليختار منها للاستمرار في القصة.
+async def continue_story(story_id: str, choice_id: int) -> StoryResponse:
+    """
+    متابعة القصة بناءً على اختيار المستخدم
+    """
+    context, metadata, user_message, messages = await _prepare_choice_turn(story_id, choice_id)
+    
+    # استدعاء DeepSeek API
+    response_text = await cached_generate(messages)
+    
+    return await _complete_turn(story_id, context, metadata, user_message, response_text)
 
-تذكر أن القصة الآن في:
-- الفقرة رقم: {current_paragraph} من {max_paragraphs}
-- إذا كانت هذه الفقرة الأخيرة أو قبل الأخيرة، قم بختم القصة بشكل مناسب.
 
-يجب أن يكون تنسيق ردك كما يلي:
+async def continue_story_with_text(story_id: str, custom_text: str) -> StoryResponse:
+    """
+    متابعة القصة بناءً على النص المخصص الذي أدخله المستخدم
+    """
+    context, metadata, user_message, messages = await _prepare_custom_turn(story_id, custom_text)
+    
+    # استدعاء DeepSeek API
+    response_text = await cached_generate(messages)
+    
+    return await _complete_turn(story_id, context, metadata, user_message, response_text)
 
-الفقرة: [نص الفقرة الجديدة من القصة]
 
-الخيارات:
-1. [الخيار الأول]
-2. [الخيار الثاني]
-3. [الخيار الثالث]
+async def _stream_and_cache(messages: List[Dict]) -> AsyncIterator[str]:
+    """
+    بث أجزاء الاستجابة مع حفظ النص الكامل في الذاكرة المؤقتة عند انتهائه
+    """
+    key = _cache_key(messages)
+    cached = await _cache_lookup(key)
+    if cached is not None:
+        yield cached
+        return
+    
+    parts = []
+    async for delta in generate_response_stream(messages):
+        parts.append(delta)
+        yield delta
+    
+    await _cache_save(key, "".join(parts))
 
-إذا كانت هذه الفقرة الأخيرة، أضف عنواناً للقصة:
 
-العنوان: [عنوان مناسب للقصة كاملة]
-"""
-    
-    print(f"Custom prompt created, length: {len(custom_prompt)}")
-    
-    # إضافة رسالة المستخدم
-    messages.append({"role": "user", "content": custom_prompt})
-    
-    # استدعاء DeepSeek API
-    print("Calling DeepSeek API...")
-    response_text = await generate_response(messages)
-    print(f"DeepSeek API response received, length: {len(response_text)}")
-    
-    # تحليل الاستجابة
-    paragraph_text, choices, title = parse_paragraph_and_choices(response_text)
-    print(f"Parsed response: paragraph length={len(paragraph_text)}, choices={choices is not None}, title={title is not None}")
-    
-    # تحديث سياق القصة
-    paragraphs.append(paragraph_text)
-    context["current_paragraph"] += 1
-    context["paragraphs"] = paragraphs
-    
-    # تحديد ما إذا كانت القصة مكتملة
-    is_complete = current_paragraph >= max_paragraphs - 1
-    print(f"Is story complete: {is_complete}")
+async def initialize_story_stream(config: StoryConfig) -> AsyncIterator[Union[str, StoryResponse]]:
+    """
+    بدء قصة جديدة مع بث نص النموذج أثناء توليده
     
-    # إذا كانت القصة مكتملة، احفظ العنوان
-    if is_complete and title:
-        metadata["title"] = title
+    Yields:
+        أجزاء النص فور وصولها، ثم StoryResponse النهائية بعد اكتمال الاستجابة
+    """
+    messages = _create_init_messages(config)
     
-    # تحديث الرسائل
-    messages.append({"role": "assistant", "content": response_text})
-    metadata["messages"] = messages
+    parts = []
+    async for delta in _stream_and_cache(messages):
+        parts.append(delta)
+        yield delta
     
-    # إنشاء فقرة القصة
-    paragraph = StoryParagraph(
-        content=paragraph_text,
-        choices=None if is_complete else choices
-    )
-    
-    # إنشاء استجابة القصة
-    story_response = StoryResponse(
-        story_id=story_id,
-        paragraph=paragraph,
-        is_complete=is_complete,
-        title=metadata["title"] if is_complete else None
-    )
+    yield await _store_new_story(config, messages, "".join(parts))
+
+
+async def continue_story_stream(
+    story_id: str,
+    choice_id: Optional[int] = None,
+    custom_text: Optional[str] = None
+) -> AsyncIterator[Union[str, StoryResponse]]:
+    """
+    متابعة القصة باختيار أو نص مخصص مع بث نص النموذج أثناء توليده
     
-    print(f"Story response created successfully")
-    return story_response
+    Yields:
+        أجزاء النص فور وصولها، ثم StoryResponse النهائية بعد اكتمال الاستجابة
+    """
+    if choice_id is not None:
+        context, metadata, user_message, messages = await _prepare_choice_turn(story_id, choice_id)
+    elif custom_text is not None:
+        context, metadata, user_message, messages = await _prepare_custom_turn(story_id, custom_text)
+    else:
+        raise ValueError("يجب تحديد اختيار أو إدخال نص مخصص")
+    
+    parts = []
+    async for delta in _stream_and_cache(messages):
+        parts.append(delta)
+        yield delta
+    
+    yield await _complete_turn(story_id, context, metadata, user_message, "".join(parts))
 
 
 async def get_complete_story(story_id: str) -> str:
     """
     الحصول على النص الكامل للقصة
     """
-    if story_id not in stories_context:
-        raise ValueError("معرف القصة غير صالح")
-    
-    context = stories_context[story_id]
-    metadata = stories_metadata.get(story_id, {})
+    context, metadata = await _get_story_state(story_id)
     
     story_text = "\n\n".join(context["paragraphs"])
     
@@ -416,23 +816,14 @@ async def get_complete_story(story_id: str) -> str:
     return story_text
 
 
-async def generate_title_if_missing(story_id: str) -> str:
+async def _generate_title(story_id: str) -> str:
     """
-    توليد عنوان للقصة إذا لم يكن موجوداً
+    توليد عنوان للقصة المكتملة وحفظه في معلومات القصة
     """
-    if story_id not in stories_metadata:
-        raise ValueError("معرف القصة غير صالح")
-        
-    metadata = stories_metadata[story_id]
-    
-    # إذا كان العنوان موجوداً بالفعل، أعده
-    if metadata.get("title"):
-        return metadata["title"]
-    
     # توليد العنوان
     complete_story = await get_complete_story(story_id)
     
-    system_prompt = get_system_prompt()
+    system_prompt = SYSTEM_PROMPT
     title_prompt = create_title_prompt(complete_story)
     
     messages = [
@@ -445,21 +836,56 @@ async def generate_title_if_missing(story_id: str) -> str:
     # تنظيف العنوان
     title = title.strip().replace("العنوان:", "").strip()
     
-    # حفظ العنوان
+    # حفظ العنوان (نعيد تحميل القصة لأنها قد تكون تغيرت أثناء انتظار النموذج)
+    context, metadata = await _get_story_state(story_id)
     metadata["title"] = title
+    await save_story(story_id, context, metadata)
     
     return title
 
+
+def _on_title_task_done(story_id: str, task: asyncio.Task) -> None:
+    """
+    إزالة مهمة توليد العنوان بعد انتهائها وتسجيل الخطأ إن وجد
+    """
+    _title_tasks.pop(story_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("فشل توليد عنوان القصة %s: %s", story_id, task.exception())
+
+
+def _schedule_title_generation(story_id: str) -> asyncio.Task:
+    """
+    بدء توليد العنوان في الخلفية أو إرجاع المهمة الجارية لنفس القصة
+    """
+    task = _title_tasks.get(story_id)
+    if task is None:
+        task = asyncio.create_task(_generate_title(story_id))
+        _title_tasks[story_id] = task
+        task.add_done_callback(lambda t: _on_title_task_done(story_id, t))
+    return task
+
+
+async def generate_title_if_missing(story_id: str) -> str:
+    """
+    توليد عنوان للقصة إذا لم يكن موجوداً، أو انتظار التوليد الجاري في الخلفية
+    """
+    _, metadata = await _get_story_state(story_id)
+    
+    # إذا كان العنوان موجوداً بالفعل، أعده
+    if metadata.get("title"):
+        return metadata["title"]
+    
+    # حماية المهمة المشتركة من الإلغاء إذا أُلغي أحد المنتظرين
+    return await asyncio.shield(_schedule_title_generation(story_id))
+
 async def edit_story(story_id: str, edit_instructions: str) -> dict:
     """
     تعديل القصة بناءً على تعليمات المستخدم
     """
-    if story_id not in stories_context or story_id not in stories_metadata:
-        raise ValueError("معرف القصة غير صالح")
+    context, metadata = await _get_story_state(story_id)
     
     # الحصول على نص القصة الكامل
-    paragraphs = stories_context[story_id]["paragraphs"]
-    complete_story = "\n".join(paragraphs)
+    complete_story = context["joined"]
     
     # إنشاء برومبت للتعديل
     system_prompt = """أنت مساعد ذكي متخصص في تحرير وتعديل القصص العربية. مهمتك هي تعديل القصة بناءً على تعليمات المستخدم مع الحفاظ على الأسلوب والنبرة الأصلية. 
@@ -482,27 +908,52 @@ async def edit_story(story_id: str, edit_instructions: str) -> dict:
     ]
     
     # استدعاء DeepSeek API
-    response_text = await generate_response(messages)
+    response_text = await cached_generate(messages)
     
     # تحليل النص واستخراج العنوان الجديد إذا وجد
     new_title = None
-    title_match = re.search(r"العنوان الجديد:\s*(.*?)(?:\n|$)", response_text, re.IGNORECASE)
+    title_match = _NEW_TITLE_RE.search(response_text)
     if title_match:
         new_title = title_match.group(1).strip()
-        response_text = re.sub(r"العنوان الجديد:\s*.*?(?:\n|$)", "", response_text, flags=re.IGNORECASE)
+        # حذف سطر العنوان باستخدام موضع المطابقة نفسها بدلاً من مسح النص مرة أخرى
+        response_text = response_text[:title_match.start()] + response_text[title_match.end():]
     
     # تقسيم النص المعدل إلى فقرات
     edited_paragraphs = [p.strip() for p in response_text.split("\n\n") if p.strip()]
     
     # تحديث القصة في التخزين
-    stories_context[story_id]["paragraphs"] = edited_paragraphs
+    context["paragraphs"] = edited_paragraphs
+    context["joined"] = "\n".join(edited_paragraphs)
     
     # تحديث العنوان إذا كان هناك عنوان جديد
     if new_title:
-        stories_metadata[story_id]["title"] = new_title
+        metadata["title"] = new_title
+    
+    await save_story(story_id, context, metadata)
+    
+    # الصوت المولد سابقاً لم يعد يطابق نص القصة
+    await _invalidate_story_audio(story_id)
     
     # إرجاع البيانات المعدلة
     return {
         "paragraphs": edited_paragraphs,
-        "title": new_title or stories_metadata[story_id].get("title")
-    }
\ No newline at end of file
+        "title": new_title or metadata.get("title")
+    }
+
+
+async def _invalidate_story_audio(story_id: str) -> None:
+    """
+    حذف صوت القصة المحفوظ (استيراد متأخر لأن tts_service يستورد هذه الوحدة)
+    """
+    from tts_service import invalidate_story_audio
+    await invalidate_story_audio(story_id)
+
+
+async def delete_story(story_id: str) -> None:
+    """
+    حذف سياق القصة ومعلوماتها من التخزين
+    """
+    if not await remove_story(story_id):
+        raise ValueError("معرف القصة غير صالح")
+    
+    await _invalidate_story_audio(story_id)
\ No newline at end of file
@@ -10,15 +10,17 @@ import logging
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
-from pathlib import Path
 
 # Add the current directory to Python path to enable imports
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 # Import application routers
 from routers import story
+from ai_service import get_client, close_client
+from story_store import REDIS_URL, close_store
+from tts_service import ensure_storage_path, start_local_tts, stop_local_tts
 
 # ======== Configure Logging ========
 logging.basicConfig(level=logging.INFO)
@@ -43,10 +45,11 @@ logger.info(f"Port: {PORT}")
 logger.info(f"Base URL: {BASE_URL}")
 logger.info(f"Audio storage path: {AUDIO_STORAGE_PATH}")
 logger.info(f"DeepSeek API Key set: {bool(DEEPSEEK_API_KEY)}")
+logger.info(f"Redis story store: {bool(REDIS_URL)}")
 
 # ======== Ensure Audio Storage Directory Exists ========
 try:
-    Path(AUDIO_STORAGE_PATH).mkdir(parents=True, exist_ok=True)
+    ensure_storage_path()
     logger.info(f"Created/verified audio storage directory at: {AUDIO_STORAGE_PATH}")
 except Exception as e:
     logger.error(f"Error creating audio storage directory: {str(e)}")
@@ -56,7 +59,9 @@ except Exception as e:
 app = FastAPI(
     title="راوي API",
     description="واجهة برمجة تطبيقات لمنصة راوي لتوليد القصص العربية باستخدام الذكاء الاصطناعي",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson يكتب النص العربي بـ UTF-8 مباشرة دون تهريب \uXXXX وبسرعة أكبر
+    default_response_class=ORJSONResponse
 )
 
 # ======== Configure CORS ========
@@ -71,6 +76,30 @@ app.add_middleware(
 # ======== Mount Static Files ========
 app.mount("/audio", StaticFiles(directory=AUDIO_STORAGE_PATH), name="audio")
 
+# ======== Lifecycle Hooks ========
+@app.on_event("startup")
+async def startup_http_client():
+    """
+    Open the shared DeepSeek HTTP client so the first request doesn't pay for it
+    """
+    app.state.http = await get_client()
+
+@app.on_event("startup")
+async def startup_tts():
+    """
+    Load the local TTS model once when TTS_BACKEND selects it
+    """
+    await start_local_tts()
+
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    """
+    Close the shared DeepSeek HTTP client, the story store connection and the local TTS worker
+    """
+    await close_client()
+    await close_store()
+    await stop_local_tts()
+
 # ======== Register Routers ========
 app.include_router(story.router, prefix="/api/stories", tags=["قصص"])
 
@@ -104,9 +133,18 @@ async def health_check():
 
 # ======== Run Application ========
 if __name__ == "__main__":
-    uvicorn.run(
-        "main:app",
-        host=HOST,
-        port=PORT,
-        reload=True  # Disable in production for better performance
-    )
\ No newline at end of file
+    if REDIS_URL:
+        # Story state lives in Redis, so every worker can serve every story
+        uvicorn.run(
+            "main:app",
+            host=HOST,
+            port=PORT,
+            workers=os.cpu_count()
+        )
+    else:
+        uvicorn.run(
+            "main:app",
+            host=HOST,
+            port=PORT,
+            reload=True  # Disable in production for better performance
+        )
\ No newline at end of file
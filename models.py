@@ -5,7 +5,7 @@ Data models for API requests and responses
 
 from enum import Enum
 from typing import List, Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 
 
 # ======== Enum Types ========
@@ -60,6 +60,13 @@ class ChoiceRequest(BaseModel):
     choice_id: Optional[int] = Field(None, description="معرف الاختيار الذي تم اختياره")
     custom_text: Optional[str] = Field(None, description="النص المخصص الذي أدخله المستخدم")
 
+    @model_validator(mode="after")
+    def _check_one_of(self) -> "ChoiceRequest":
+        # يُرفض الطلب عند التحليل إذا لم يحدد اختياراً أو نصاً مخصصاً، أو حدد الاثنين معاً
+        if (self.choice_id is None) == (self.custom_text is None):
+            raise ValueError("اختر واحداً فقط: choice_id أو custom_text")
+        return self
+
 
 class TTSRequest(BaseModel):
     """Request to generate text-to-speech for a story"""
@@ -95,6 +102,11 @@ class StoryResponse(BaseModel):
     title: Optional[str] = Field(default=None, description="عنوان القصة (يتم إضافته عند اكتمال القصة)")
 
 
+class TitleResponse(BaseModel):
+    """Response containing the story title"""
+    title: str = Field(..., description="عنوان القصة")
+
+
 class TTSResponse(BaseModel):
     """Response containing URL to audio file"""
     audio_url: str = Field(..., description="رابط ملف الصوت")
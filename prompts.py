@@ -1,12 +1,14 @@
-from typing import List, Dict, Any
+import textwrap
+from functools import lru_cache
+from string import Template
+from types import MappingProxyType
+from typing import List, Any, Final, Mapping
 from models import StoryLength, StoryType, Character, StoryConfig
 
 
-def get_system_prompt() -> str:
-    """
-    الحصول على برومبت النظام الأساسي الذي يحدد سلوك نموذج الذكاء الاصطناعي
-    """
-    return """
+# برومبت النظام ثابت، فيُبنى مرة واحدة عند التحميل
+# ويُرسل دائماً كأول رسالة حتى يبقى بادئة ثابتة يستفيد منها التخزين المؤقت للبرومبت لدى مزود النموذج
+_SYSTEM_PROMPT: Final[str] = textwrap.dedent("""
     You are a professional and creative Arabic story writer. Your task is to write original, engaging, and cohesive Arabic stories.
     
     Adhere to the following standards in all the stories you write:
@@ -42,7 +44,14 @@ def get_system_prompt() -> str:
     4. Maintain story consistency despite the change in path.
     
     When the story is complete, choose an engaging and deep title that reflects the essence and content of the story.
+    """).strip()
+
+
+def get_system_prompt() -> str:
+    """
+    الحصول على برومبت النظام الأساسي الذي يحدد سلوك نموذج الذكاء الاصطناعي
     """
+    return _SYSTEM_PROMPT
 
 
 def format_characters_info(characters: List[Character]) -> str:
@@ -52,27 +61,32 @@ def format_characters_info(characters: List[Character]) -> str:
     if not characters:
         return "لا توجد شخصيات محددة، يمكنك إنشاء شخصيات مناسبة للقصة."
     
-    characters_info = "معلومات الشخصيات:\n"
-    for i, character in enumerate(characters, 1):
-        gender_text = "ذكر" if character.gender.value == "ذكر" else "أنثى"
-        characters_info += f"{i}. الشخصية: {character.name}، الجنس: {gender_text}، الوصف: {character.description}\n"
+    lines = ["معلومات الشخصيات:"]
+    lines.extend(
+        f"{i}. الشخصية: {c.name}، الجنس: {'ذكر' if c.gender.value == 'ذكر' else 'أنثى'}، الوصف: {c.description}"
+        for i, c in enumerate(characters, 1)
+    )
     
-    return characters_info
+    # كل سطر ينتهي بسطر جديد كما في الصيغة السابقة حتى لا يتغير نص البرومبت
+    return "\n".join(lines) + "\n"
 
 
-def get_story_length_instructions(length: StoryLength) -> Dict[str, Any]:
+# تعليمات الطول ثابتة، فتُبنى مرة واحدة وتُعاد للقراءة فقط حتى لا يعدلها أحد المستدعين
+_LENGTH_MAPPING: Final[Mapping[StoryLength, Mapping[str, Any]]] = MappingProxyType({
+    StoryLength.SHORT: MappingProxyType({"paragraphs": 3, "description": "قصة قصيرة تتكون من 3 فقرات"}),
+    StoryLength.MEDIUM: MappingProxyType({"paragraphs": 5, "description": "قصة متوسطة الطول تتكون من 5 فقرات"}),
+    StoryLength.LONG: MappingProxyType({"paragraphs": 7, "description": "قصة طويلة تتكون من 7 فقرات"})
+})
+
+
+def get_story_length_instructions(length: StoryLength) -> Mapping[str, Any]:
     """
     الحصول على تعليمات طول القصة وعدد الفقرات
     """
-    length_mapping = {
-        StoryLength.SHORT: {"paragraphs": 3, "description": "قصة قصيرة تتكون من 3 فقرات"},
-        StoryLength.MEDIUM: {"paragraphs": 5, "description": "قصة متوسطة الطول تتكون من 5 فقرات"},
-        StoryLength.LONG: {"paragraphs": 7, "description": "قصة طويلة تتكون من 7 فقرات"}
-    }
-    
-    return length_mapping.get(length, length_mapping[StoryLength.MEDIUM])
+    return _LENGTH_MAPPING.get(length, _LENGTH_MAPPING[StoryLength.MEDIUM])
 
 
+@lru_cache(maxsize=None)
 def get_story_type_description(primary_type: StoryType, secondary_type: StoryType) -> str:
     """
     الحصول على وصف نوع القصة
@@ -83,19 +97,9 @@ def get_story_type_description(primary_type: StoryType, secondary_type: StoryTyp
         return f"قصة تجمع بين نوعي {primary_type.value} و{secondary_type.value}"
 
 
-def create_story_init_prompt(config: StoryConfig) -> str:
-    """
-    إنشاء البرومبت الأولي لبدء القصة
-    """
-    length_info = get_story_length_instructions(config.length)
-    story_type = get_story_type_description(config.primary_type, config.secondary_type)
-    characters_info = format_characters_info(config.characters)
-    
-    prompt = f"""
-    Please write {length_info['description']} of {story_type}.
-    
-    {characters_info}
-    
+# قوالب البرومبت تُبنى مرة واحدة عند التحميل، وكل طلب يكتفي بتعويض المتغيرات
+# التعليمات الثابتة أولاً والأجزاء المتغيرة في النهاية لإطالة البادئة المشتركة بين جميع القصص
+_STORY_INIT_TEMPLATE: Final[Template] = Template("""
     Required from you:
     1. Write the first paragraph of the story (4-6 lines) in Arabic.
     2. Start the story with a strong and engaging beginning that captivates the reader from the first line.
@@ -115,22 +119,18 @@ def create_story_init_prompt(config: StoryConfig) -> str:
     1. [Character name + action verb in Arabic, 3-5 words total]
     2. [Character name + different action verb in Arabic, 3-5 words total]
     3. [Character name + another different action verb in Arabic, 3-5 words total]
-    """
     
-    return prompt
-
-
-def create_continuation_prompt(story_context: str, choice_id: int, choice_text: str, current_paragraph: int, max_paragraphs: int) -> str:
-    """
-    إنشاء برومبت لاستكمال القصة بناءً على اختيار المستخدم
-    """
-    is_final = current_paragraph >= max_paragraphs - 1
+    Story request:
+    Please write $length_description of $story_type.
     
-    prompt = f"""
+    $characters_info
+    """)
+
+_CONTINUATION_HEAD = """
     Story context so far:
-    {story_context}
+    $story_context
     
-    The user chose path number {choice_id}: {choice_text}
+    The user chose path number $choice_id: $choice_text
     
     Required from you:
     1. Continue writing the story with a new paragraph (4-6 lines) in Arabic that directly follows the choice made by the user.
@@ -138,9 +138,8 @@ def create_continuation_prompt(story_context: str, choice_id: int, choice_text:
     3. Add unexpected and exciting developments to engage the reader.
     4. Maintain consistency in the story's characters and world.
     """
-    
-    if is_final:
-        prompt += """
+
+_FINAL_CONTINUATION_TEMPLATE: Final[Template] = Template(_CONTINUATION_HEAD + """
     5. This is the final paragraph of the story, so end the story in a logical and satisfying way that closes all open paths.
     6. Suggest an appropriate and deep title for the complete story.
     
@@ -151,9 +150,9 @@ def create_continuation_prompt(story_context: str, choice_id: int, choice_text:
     
     العنوان:
     [Write the suggested title for the story here in Arabic]
-    """
-    else:
-        prompt += """
+    """)
+
+_CONTINUATION_TEMPLATE: Final[Template] = Template(_CONTINUATION_HEAD + """
     5. Present 3 short, logical, and practical options for continuing the story.
     6. Make the options very short (3-5 words only) in Arabic.
     7. ALWAYS include the character's name in each option before the action verb.
@@ -170,9 +169,83 @@ def create_continuation_prompt(story_context: str, choice_id: int, choice_text:
     1. [Character name + action verb in Arabic, 3-5 words total]
     2. [Character name + different action verb in Arabic, 3-5 words total]
     3. [Character name + another different action verb in Arabic, 3-5 words total]
+    """)
+
+
+def create_story_init_prompt(config: StoryConfig) -> str:
     """
+    إنشاء البرومبت الأولي لبدء القصة
+    """
+    length_info = get_story_length_instructions(config.length)
     
-    return prompt
+    return _STORY_INIT_TEMPLATE.substitute(
+        length_description=length_info['description'],
+        story_type=get_story_type_description(config.primary_type, config.secondary_type),
+        characters_info=format_characters_info(config.characters)
+    )
+
+
+def create_continuation_prompt(story_context: str, choice_id: int, choice_text: str, current_paragraph: int, max_paragraphs: int) -> str:
+    """
+    إنشاء برومبت لاستكمال القصة بناءً على اختيار المستخدم
+    """
+    is_final = current_paragraph >= max_paragraphs - 1
+    template = _FINAL_CONTINUATION_TEMPLATE if is_final else _CONTINUATION_TEMPLATE
+    
+    return template.substitute(
+        story_context=story_context,
+        choice_id=choice_id,
+        choice_text=choice_text
+    )
+
+
+# أجزاء ثابتة لبرومبت المتابعة بالنص المخصص، تُدمج مع السياق دون إعادة بناء القالب في كل طلب
+CUSTOM_CONTINUATION_HEAD = """
+لقد وصلنا إلى هذه النقطة في القصة:
+
+"""
+
+CUSTOM_CONTINUATION_MID = """
+
+المستخدم اختار أن يكتب رداً مخصصاً بدلاً من اختيار أحد الخيارات المقدمة. الرد المخصص للمستخدم هو:
+
+\""""
+
+CUSTOM_CONTINUATION_TAIL_FMT = """"
+
+بناءً على هذا المدخل من المستخدم، استمر في القصة واكتب فقرة جديدة تأخذ بعين الاعتبار ما كتبه المستخدم.
+ثم قدم 3 خيارات جديدة للمستخدم ليختار منها للاستمرار في القصة.
+
+تذكر أن القصة الآن في:
+- الفقرة رقم: {current_paragraph} من {max_paragraphs}
+- إذا كانت هذه الفقرة الأخيرة أو قبل الأخيرة، قم بختم القصة بشكل مناسب.
+
+يجب أن يكون تنسيق ردك كما يلي:
+
+الفقرة: [نص الفقرة الجديدة من القصة]
+
+الخيارات:
+1. [الخيار الأول]
+2. [الخيار الثاني]
+3. [الخيار الثالث]
+
+إذا كانت هذه الفقرة الأخيرة، أضف عنواناً للقصة:
+
+العنوان: [عنوان مناسب للقصة كاملة]
+"""
+
+
+def create_custom_continuation_prompt(story_context: str, custom_text: str, current_paragraph: int, max_paragraphs: int) -> str:
+    """
+    إنشاء برومبت لاستكمال القصة بناءً على النص المخصص الذي أدخله المستخدم
+    """
+    return "".join((
+        CUSTOM_CONTINUATION_HEAD,
+        story_context,
+        CUSTOM_CONTINUATION_MID,
+        custom_text,
+        CUSTOM_CONTINUATION_TAIL_FMT.format(current_paragraph=current_paragraph, max_paragraphs=max_paragraphs)
+    ))
 
 
 def create_title_prompt(complete_story: str) -> str:
@@ -1,12 +1,17 @@
 import os
+import stat
 import logging
-from fastapi import APIRouter, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
-from pathlib import Path
+from typing import AsyncIterator, Optional, Tuple, Union
+import orjson
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Request
+from fastapi.responses import FileResponse, StreamingResponse, Response
 
-from models import StoryConfig, StoryResponse, ChoiceRequest, TTSRequest, TTSResponse, EditRequest, EditResponse
-from ai_service import initialize_story, continue_story, continue_story_with_text, get_complete_story, edit_story
-from tts_service import generate_audio_for_story, get_audio_url
+from models import StoryConfig, StoryResponse, ChoiceRequest, TTSRequest, TTSResponse, EditRequest, EditResponse, TitleResponse
+from ai_service import (
+    initialize_story, continue_story, continue_story_with_text, get_complete_story, edit_story, delete_story,
+    generate_title_if_missing, initialize_story_stream, continue_story_stream
+)
+from tts_service import generate_audio_for_story, get_audio_url, stream_audio_for_story, iter_audio_file
 
 # إعداد التسجيل
 logging.basicConfig(level=logging.INFO)
@@ -18,8 +23,12 @@ router = APIRouter()
 AUDIO_STORAGE_PATH = os.path.abspath(os.getenv("AUDIO_STORAGE_PATH", "./audio_files"))
 BASE_URL = os.getenv("BASE_URL", "http://localhost:8000")
 
-logger.info(f"Audio storage path: {AUDIO_STORAGE_PATH}")
-logger.info(f"Base URL: {BASE_URL}")
+logger.info("Audio storage path: %s", AUDIO_STORAGE_PATH)
+logger.info("Base URL: %s", BASE_URL)
+
+# عند التشغيل خلف nginx يُترك إرسال الملفات الصوتية له عبر X-Accel-Redirect
+USE_XACCEL = os.getenv("USE_XACCEL") == "1"
+XACCEL_AUDIO_PREFIX = os.getenv("XACCEL_AUDIO_PREFIX", "/internal/audio/")
 
 
 @router.post("/initialize", response_model=StoryResponse)
@@ -29,13 +38,14 @@ async def create_story(config: StoryConfig):
     """
     try:
         # Log the incoming request data
-        print(f"Request data: {config.dict()}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Request data: %s", config.model_dump_json())
         
         response = await initialize_story(config)
         return response
     except Exception as e:
         # Log the error details
-        print(f"Error details: {str(e)}")
+        logger.error("Error in create_story: %s", e)
         raise HTTPException(status_code=500, detail=f"حدث خطأ أثناء إنشاء القصة: {str(e)}")
 
 
@@ -46,24 +56,77 @@ async def continue_story_route(request: ChoiceRequest):
     """
     try:
         # Log the request for debugging
-        logger.info(f"Continuing story with: {request.dict()}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Continuing story with: %s", request.model_dump_json())
         
+        # ChoiceRequest يضمن وجود الاختيار أو النص المخصص فقط
         if request.choice_id is not None:
-            # استخدام الاختيار المحدد
-            response = await continue_story(request.story_id, request.choice_id)
-        elif request.custom_text is not None:
-            # استخدام النص المخصص
-            response = await continue_story_with_text(request.story_id, request.custom_text)
-        else:
-            # لا يوجد اختيار أو نص مخصص
-            raise ValueError("يجب تحديد اختيار أو إدخال نص مخصص")
-            
-        return response
+            return await continue_story(request.story_id, request.choice_id)
+        return await continue_story_with_text(request.story_id, request.custom_text)
+    except ValueError as e:
+        logger.error("ValueError in continue_story_route: %s", e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error("Error in continue_story_route: %s", e)
+        raise HTTPException(status_code=500, detail=f"حدث خطأ أثناء متابعة القصة: {str(e)}")
+
+
+async def _sse_events(first: Union[str, StoryResponse], stream: AsyncIterator[Union[str, StoryResponse]]):
+    """
+    تحويل أجزاء النص إلى أحداث SSE، والاستجابة النهائية إلى حدث done
+    """
+    item = first
+    try:
+        while True:
+            if isinstance(item, StoryResponse):
+                yield f"event: done\ndata: {item.model_dump_json()}\n\n"
+            else:
+                yield f"data: {orjson.dumps({'t': item}).decode()}\n\n"
+            item = await stream.__anext__()
+    except StopAsyncIteration:
+        return
+    except Exception as e:
+        # بعد بدء البث لا يمكن تغيير رمز الحالة، فنرسل الخطأ كحدث
+        logger.error("Error while streaming story: %s", e)
+        yield f"event: error\ndata: {orjson.dumps({'detail': str(e)}).decode()}\n\n"
+
+
+async def _start_sse(stream: AsyncIterator[Union[str, StoryResponse]]) -> StreamingResponse:
+    """
+    انتظار أول جزء قبل بدء البث حتى تظهر أخطاء التحقق كرموز حالة HTTP عادية
+    """
+    first = await stream.__anext__()
+    return StreamingResponse(
+        _sse_events(first, stream),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post("/initialize/stream")
+async def create_story_stream(config: StoryConfig):
+    """
+    بدء قصة جديدة مع بث النص أثناء توليده (Server-Sent Events)
+    """
+    try:
+        return await _start_sse(initialize_story_stream(config))
+    except Exception as e:
+        logger.error("Error in create_story_stream: %s", e)
+        raise HTTPException(status_code=500, detail=f"حدث خطأ أثناء إنشاء القصة: {str(e)}")
+
+
+@router.post("/continue/stream")
+async def continue_story_stream_route(request: ChoiceRequest):
+    """
+    متابعة القصة مع بث النص أثناء توليده (Server-Sent Events)
+    """
+    try:
+        return await _start_sse(continue_story_stream(request.story_id, request.choice_id, request.custom_text))
     except ValueError as e:
-        logger.error(f"ValueError in continue_story_route: {str(e)}")
+        logger.error("ValueError in continue_story_stream_route: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"Error in continue_story_route: {str(e)}")
+        logger.error("Error in continue_story_stream_route: %s", e)
         raise HTTPException(status_code=500, detail=f"حدث خطأ أثناء متابعة القصة: {str(e)}")
 
 
@@ -81,54 +144,172 @@ async def get_story(story_id: str):
         raise HTTPException(status_code=500, detail=f"حدث خطأ أثناء استرجاع القصة: {str(e)}")
 
 
+@router.get("/story/{story_id}/title", response_model=TitleResponse)
+async def get_story_title(story_id: str):
+    """
+    الحصول على عنوان القصة، مع انتظار توليده إذا كان جارياً في الخلفية
+    """
+    try:
+        title = await generate_title_if_missing(story_id)
+        return TitleResponse(title=title)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"حدث خطأ أثناء توليد عنوان القصة: {str(e)}")
+
+
+@router.delete("/story/{story_id}")
+async def delete_story_route(story_id: str):
+    """
+    حذف القصة من الذاكرة بعد انتهاء المستخدم منها
+    """
+    try:
+        await delete_story(story_id)
+        return {"success": True}
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
 @router.post("/tts", response_model=TTSResponse)
 async def generate_tts(request: TTSRequest):
     """
     توليد ملف صوتي للقصة بسرعة محددة
     """
     try:
-        logger.info(f"Generating TTS for story ID: {request.story_id} with speed: {request.speed}")
+        logger.info("Generating TTS for story ID: %s with speed: %s", request.story_id, request.speed)
         
         # توليد أو استرجاع الملف الصوتي
-        audio_filename = await generate_audio_for_story(request.story_id)
-        logger.info(f"Audio filename: {audio_filename}")
+        audio_filename = await generate_audio_for_story(request.story_id, request.speed)
+        logger.info("Audio filename: %s", audio_filename)
         
         # إنشاء URL للملف الصوتي مع تمرير معلومات السرعة
         audio_url = get_audio_url(audio_filename, request.speed)
-        logger.info(f"Audio URL: {audio_url}")
+        logger.info("Audio URL: %s", audio_url)
         
         return TTSResponse(audio_url=audio_url)
     except ValueError as e:
-        logger.error(f"ValueError in generate_tts: {str(e)}")
+        logger.error("ValueError in generate_tts: %s", e)
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        logger.error(f"Error in generate_tts: {str(e)}")
+        logger.error("Error in generate_tts: %s", e)
         raise HTTPException(status_code=500, detail=f"حدث خطأ أثناء توليد الصوت: {str(e)}")
 
 
+@router.get("/tts/stream/{story_id}")
+async def stream_tts(story_id: str):
+    """
+    بث صوت القصة مباشرة أثناء توليده بدلاً من انتظار الملف ثم طلبه مرة أخرى
+    """
+    try:
+        logger.info("Streaming TTS for story ID: %s", story_id)
+        audio_stream = await stream_audio_for_story(story_id)
+        return StreamingResponse(audio_stream, media_type="audio/mpeg")
+    except ValueError as e:
+        logger.error("ValueError in stream_tts: %s", e)
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error("Error in stream_tts: %s", e)
+        raise HTTPException(status_code=500, detail=f"حدث خطأ أثناء توليد الصوت: {str(e)}")
+
+
+def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    تحليل ترويسة Range وإرجاع بداية ونهاية المقطع المطلوب، أو None لإرسال الملف كاملاً
+    """
+    unit, _, ranges = range_header.partition("=")
+    # ندعم مقطعاً واحداً فقط، وغير ذلك يُرسل الملف كاملاً كما يسمح المعيار
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+    
+    start_text, _, end_text = ranges.strip().partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            # bytes=-N تعني آخر N بايت
+            start = max(size - int(end_text), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    
+    if start >= size or start > end:
+        raise ValueError("نطاق غير صالح")
+    
+    return start, min(end, size - 1)
+
+
 @router.get("/audio/{filename}")
-async def get_audio_file(filename: str):
+async def get_audio_file(filename: str, request: Request):
     """
-    استرجاع ملف صوتي محدد
+    استرجاع ملف صوتي محدد، مع دعم طلب جزء منه للتنقل داخل المقطع
     """
     try:
+        # منع الوصول إلى ملفات خارج مجلد التخزين، يكفي رفض أي فاصل مسار دون استدعاءات نظام إضافية
+        if os.sep in filename or "/" in filename or filename in (".", ".."):
+            raise HTTPException(status_code=404, detail="الملف الصوتي غير موجود")
+        
         file_path = os.path.join(AUDIO_STORAGE_PATH, filename)
-        logger.info(f"Attempting to serve audio file: {file_path}")
+        logger.info("Attempting to serve audio file: %s", file_path)
+        
+        # فحص واحد لوجود الملف ونوعه وحجمه، تُعاد نتيجته في FileResponse
+        try:
+            file_stat = os.stat(file_path)
+        except (FileNotFoundError, NotADirectoryError):
+            file_stat = None
         
-        if not Path(file_path).exists():
-            logger.error(f"Audio file not found: {file_path}")
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+            logger.error("Audio file not found: %s", file_path)
             raise HTTPException(status_code=404, detail="الملف الصوتي غير موجود")
         
-        logger.info(f"Serving audio file: {file_path}")
+        if USE_XACCEL:
+            # nginx يرسل الملف من النواة مباشرة ويتولى طلبات Range
+            return Response(headers={
+                "X-Accel-Redirect": f"{XACCEL_AUDIO_PREFIX}{filename}",
+                "Content-Type": "audio/mpeg",
+                "Content-Disposition": f'inline; filename="{filename}"',
+                "Cache-Control": "public, max-age=31536000, immutable"
+            })
+        
+        size = file_stat.st_size
+        headers = {
+            "Accept-Ranges": "bytes",
+            # أسماء الملفات فريدة ومحتواها لا يتغير
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "ETag": f'"{file_stat.st_mtime_ns:x}-{size:x}"'
+        }
+        
+        range_header = request.headers.get("range")
+        if range_header:
+            try:
+                byte_range = _parse_range(range_header, size)
+            except ValueError:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+            
+            if byte_range is not None:
+                start, end = byte_range
+                length = end - start + 1
+                headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+                headers["Content-Length"] = str(length)
+                return StreamingResponse(
+                    iter_audio_file(file_path, start, length),
+                    status_code=206,
+                    media_type="audio/mpeg",
+                    headers=headers
+                )
+        
+        logger.info("Serving audio file: %s", file_path)
         return FileResponse(
             path=file_path,
             media_type="audio/mpeg",
-            filename=filename
+            filename=filename,
+            stat_result=file_stat,
+            headers=headers
         )
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error serving audio file: {str(e)}")
+        logger.error("Error serving audio file: %s", e)
         raise HTTPException(status_code=500, detail=f"حدث خطأ أثناء استرجاع الملف الصوتي: {str(e)}")
 
 
@@ -138,8 +319,8 @@ async def edit_story_endpoint(request: EditRequest):
     تعديل القصة بناءً على تعليمات المستخدم
     """
     try:
-        logger.info(f"Editing story with ID: {request.story_id}")
-        logger.info(f"Edit instructions: {request.edit_instructions}")
+        logger.info("Editing story with ID: %s", request.story_id)
+        logger.info("Edit instructions: %s", request.edit_instructions)
         
         # استدعاء خدمة التعديل
         edit_result = await edit_story(request.story_id, request.edit_instructions)
@@ -150,8 +331,8 @@ async def edit_story_endpoint(request: EditRequest):
             title=edit_result["title"]
         )
     except ValueError as e:
-        logger.error(f"ValueError in edit_story_endpoint: {str(e)}")
+        logger.error("ValueError in edit_story_endpoint: %s", e)
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        logger.error(f"Error in edit_story_endpoint: {str(e)}")
+        logger.error("Error in edit_story_endpoint: %s", e)
         raise HTTPException(status_code=500, detail=f"حدث خطأ أثناء تعديل القصة: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""
+راوي (Rawi) - Arabic AI Storytelling Platform
+Story state storage shared by the story services
+"""
+
+import os
+from typing import Dict, Optional, Tuple
+
+import orjson
+from cachetools import TTLCache
+from dotenv import load_dotenv
+
+# تحميل المتغيرات البيئية
+load_dotenv()
+
+# عند تحديد REDIS_URL تُحفظ القصص في Redis وتصبح مشتركة بين العمليات (workers)
+# وإلا تُحفظ في ذاكرة العملية الحالية فقط
+REDIS_URL = os.getenv("REDIS_URL")
+
+# نحدد عدد القصص ومدة بقائها حتى لا تبقى القصص المهجورة في الذاكرة إلى الأبد
+STORY_CACHE_SIZE = int(os.getenv("STORY_CACHE_SIZE", "10000"))
+STORY_TTL_SECONDS = int(os.getenv("STORY_TTL_SECONDS", str(6 * 3600)))
+
+# سياق القصة ومعلوماتها
+StoryState = Tuple[Dict, Dict]
+
+
+def _create_redis_client():
+    """
+    إنشاء عميل Redis غير متزامن إذا كان REDIS_URL محدداً
+    """
+    if not REDIS_URL:
+        return None
+
+    import redis.asyncio as redis
+    return redis.from_url(REDIS_URL)
+
+
+redis_client = _create_redis_client()
+
+
+class MemoryStoryStore:
+    """In-process story storage bounded by size and TTL"""
+
+    def __init__(self, maxsize: int, ttl: int):
+        self._stories = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def load(self, story_id: str) -> Optional[StoryState]:
+        return self._stories.get(story_id)
+
+    async def save(self, story_id: str, context: Dict, metadata: Dict) -> None:
+        # إعادة الحفظ تجدد مدة صلاحية القصة النشطة
+        self._stories[story_id] = (context, metadata)
+
+    async def delete(self, story_id: str) -> bool:
+        return self._stories.pop(story_id, None) is not None
+
+
+class RedisStoryStore:
+    """Story storage shared across workers and restarts through Redis"""
+
+    def __init__(self, client, ttl: int):
+        self._redis = client
+        self._ttl = ttl
+
+    @staticmethod
+    def _key(story_id: str) -> str:
+        return f"story:{story_id}"
+
+    async def load(self, story_id: str) -> Optional[StoryState]:
+        raw = await self._redis.get(self._key(story_id))
+        if raw is None:
+            return None
+
+        state = orjson.loads(raw)
+        metadata = state["metadata"]
+        # مفاتيح JSON نصية دائماً، فنعيد معرفات الخيارات إلى أرقام
+        metadata["last_choices"] = {int(k): v for k, v in metadata.get("last_choices", {}).items()}
+        return state["context"], metadata
+
+    async def save(self, story_id: str, context: Dict, metadata: Dict) -> None:
+        value = orjson.dumps(
+            {"context": context, "metadata": metadata},
+            option=orjson.OPT_NON_STR_KEYS
+        )
+        await self._redis.set(self._key(story_id), value, ex=self._ttl)
+
+    async def delete(self, story_id: str) -> bool:
+        return await self._redis.delete(self._key(story_id)) > 0
+
+
+if redis_client is not None:
+    _store = RedisStoryStore(redis_client, STORY_TTL_SECONDS)
+else:
+    _store = MemoryStoryStore(STORY_CACHE_SIZE, STORY_TTL_SECONDS)
+
+
+async def load_story(story_id: str) -> Optional[StoryState]:
+    """
+    تحميل سياق القصة ومعلوماتها، أو None إذا لم تكن موجودة
+    """
+    return await _store.load(story_id)
+
+
+async def save_story(story_id: str, context: Dict, metadata: Dict) -> None:
+    """
+    حفظ سياق القصة ومعلوماتها
+    """
+    await _store.save(story_id, context, metadata)
+
+
+async def remove_story(story_id: str) -> bool:
+    """
+    حذف القصة، وإرجاع True إذا كانت موجودة
+    """
+    return await _store.delete(story_id)
+
+
+async def close_store() -> None:
+    """
+    إغلاق اتصال Redis عند إيقاف الخادم
+    """
+    if redis_client is not None:
+        await redis_client.aclose()
@@ -1,78 +1,392 @@
 import os
 import asyncio
+import glob
+import logging
 import re
+import shutil
+import threading
 from gtts import gTTS
 import uuid
 import json
+import orjson
+import aiofiles
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from pathlib import Path
 from dotenv import load_dotenv
 
 from ai_service import get_complete_story, generate_title_if_missing
+from story_store import load_story, redis_client, STORY_TTL_SECONDS
 
 # تحميل المتغيرات البيئية
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # الحصول على مسار تخزين ملفات الصوت
 AUDIO_STORAGE_PATH = os.path.abspath(os.getenv("AUDIO_STORAGE_PATH", "./audio_files"))
 BASE_URL = os.getenv("BASE_URL", "http://localhost:8000")
 
-# قاموس لتخزين معرفات الملفات الصوتية للقصص
-story_audio_files = {}
+# حجم الأجزاء المقروءة عند بث ملف صوتي من القرص
+AUDIO_CHUNK_SIZE = 64 * 1024
+
+# يُقسم النص إلى أجزاء بهذا الطول تقريباً وتُولد أصواتها بالتوازي
+TTS_CHUNK_CHARS = int(os.getenv("TTS_CHUNK_CHARS", "500"))
+
+# خيوط مخصصة لطلبات gTTS حتى لا تستهلك الخيوط الافتراضية التي يستخدمها FastAPI
+_tts_executor = ThreadPoolExecutor(max_workers=int(os.getenv("TTS_WORKERS", "8")), thread_name_prefix="tts")
+
+# سرعات التشغيل التي تُحضر ملفاتها مسبقاً عند توفر ffmpeg (تشمل حدود TTSRequest من 0.5 إلى 2.0)
+# أي سرعة أخرى تُضبط في الواجهة الأمامية عبر ?speed= على الملف الأصلي
+AUDIO_SPEEDS = (0.5, 0.75, 1.0, 1.25, 1.5, 2.0)
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+# الملفات الصوتية للقصة: السرعة -> اسم الملف
+AudioFiles = Dict[str, str]
+
+# محرك تحويل النص إلى صوت: gtts (افتراضي) أو xtts لنموذج Coqui محلي يعمل دون طلبات شبكة
+TTS_BACKEND = os.getenv("TTS_BACKEND", "gtts").lower()
+TTS_MODEL_NAME = os.getenv("TTS_MODEL_NAME", "tts_models/multilingual/multi-dataset/xtts_v2")
+TTS_SPEAKER = os.getenv("TTS_SPEAKER", "Ana Florence")
+# تُجمع الأجزاء التي تصل خلال نافذة قصيرة وتُعالج معاً في دفعة واحدة
+TTS_BATCH_SIZE = int(os.getenv("TTS_BATCH_SIZE", "8"))
+TTS_BATCH_WINDOW = float(os.getenv("TTS_BATCH_WINDOW", "0.05"))
+TTS_QUEUE_SIZE = int(os.getenv("TTS_QUEUE_SIZE", "256"))
+
+# النموذج المحلي وطابور الطلبات، يبقيان None عند استخدام gTTS
+_local_tts = None
+_local_tts_queue: Optional[asyncio.Queue] = None
+_local_tts_worker: Optional[asyncio.Task] = None
+
+
+class AudioIndex:
+    """Maps each story to its generated audio files per speed, shared through Redis when available"""
+
+    def __init__(self, client=None, ttl: Optional[int] = None):
+        self._redis = client
+        self._ttl = ttl
+        # النسخة المحلية تُستخدم فقط دون Redis، حتى يظهر حذف الفهرس في جميع العمليات فوراً
+        self._local: Dict[str, AudioFiles] = {}
+
+    @staticmethod
+    def _key(story_id: str) -> str:
+        return f"tts:{story_id}"
+
+    async def get(self, story_id: str) -> Optional[AudioFiles]:
+        if self._redis is not None:
+            cached = await self._redis.get(self._key(story_id))
+            files = orjson.loads(cached) if cached is not None else None
+        else:
+            files = self._local.get(story_id)
+
+        if files is None:
+            # بعد إعادة التشغيل قد تكون الملفات موجودة على القرص دون أن تكون مسجلة
+            files = await asyncio.to_thread(_find_existing_audio, story_id)
+            if files is not None:
+                await self.set(story_id, files)
+
+        return files
+
+    async def set(self, story_id: str, files: AudioFiles) -> None:
+        if self._redis is not None:
+            # تنتهي صلاحية المدخل مع انتهاء صلاحية القصة نفسها
+            await self._redis.set(self._key(story_id), orjson.dumps(files), ex=self._ttl)
+        else:
+            self._local[story_id] = files
+
+    async def delete(self, story_id: str) -> None:
+        if self._redis is not None:
+            await self._redis.delete(self._key(story_id))
+        else:
+            self._local.pop(story_id, None)
+
+
+def _speed_key(speed: float) -> str:
+    return f"{speed:g}"
+
+
+def _variant_filename(filename: str, speed: float) -> str:
+    """
+    اسم ملف نسخة القصة المحضرة بسرعة معينة، مثل: <الاسم>@1.25.mp3
+    """
+    return f"{filename[:-len('.mp3')]}@{_speed_key(speed)}.mp3"
+
+
+def _find_existing_audio(story_id: str) -> Optional[AudioFiles]:
+    """
+    البحث عن الملفات الصوتية السابقة للقصة ونسخها بالسرعات المختلفة في مجلد التخزين
+    """
+    files = {}
+    # المعرف يأتي من العميل، فتُهرب رموز glob حتى لا يطابق ملفات قصص أخرى
+    for path in Path(AUDIO_STORAGE_PATH).glob(f"{glob.escape(story_id)}_*.mp3"):
+        _, _, speed = path.stem.partition("@")
+        files[speed or _speed_key(1.0)] = path.name
+    # لا فائدة من النسخ دون الملف الأصلي
+    return files if _speed_key(1.0) in files else None
+
+
+def _remove_audio_files(story_id: str) -> None:
+    """
+    حذف جميع الملفات الصوتية للقصة ونسخها بالسرعات المختلفة من مجلد التخزين
+    """
+    with _audio_files_lock:
+        for path in Path(AUDIO_STORAGE_PATH).glob(f"{glob.escape(story_id)}_*.mp3"):
+            path.unlink(missing_ok=True)
+
+
+def _audio_generation(story_id: str) -> int:
+    return _audio_generations.get(story_id, 0)
+
+
+async def _check_story_exists(story_id: str) -> None:
+    """
+    التحقق من وجود القصة قبل البحث في الفهرس أو على القرص، حتى لا يُقدم صوت قصة محذوفة أو معرف غير صالح
+    """
+    if await load_story(story_id) is None:
+        raise ValueError("معرف القصة غير صالح")
+
+
+# فهرس الملفات الصوتية للقصص، مشترك بين العمليات عند استخدام Redis
+audio_index = AudioIndex(redis_client, STORY_TTL_SECONDS)
+
+# مهام توليد الصوت الجارية لكل قصة، حتى تنتظر الطلبات المتزامنة نفس المهمة بدلاً من تكرارها
+_audio_tasks: Dict[str, asyncio.Task] = {}
+
+# مهام تحضير نسخ السرعات في الخلفية لكل قصة، بعد أن يُقدم الملف الأصلي
+_variant_tasks: Dict[str, asyncio.Task] = {}
+
+# يزداد عند كل إبطال لصوت القصة، فلا يُنشر صوت بدأ توليده قبل الإبطال
+# (إلغاء المهمة لا يوقف كتابة الملف الجارية في خيط آخر)
+_audio_generations: Dict[str, int] = {}
+# يجمع فحص الجيل مع نقل الملف إلى مكانه أو حذف الملفات، حتى لا يعود ملف قديم بعد حذفه
+_audio_files_lock = threading.Lock()
+
+# جدول استبدال الرموز التي قد تؤثر على القراءة الصوتية، يُطبق في مرور واحد على النص
+_TTS_TRANSLATE = str.maketrans({
+    **{c: ' ' for c in '!?،,;:#@_*=+-/\\^$"\'«»'},
+    '%': ' بالمئة ',  # استبدال علامة النسبة بكلمة "بالمئة"
+    '&': ' و ',  # استبدال علامة & بكلمة "و"
+})
+
+# الأقواس والمحتوى بداخلها (دون تجاوز نهاية السطر)
+_BRACKETS_RE = re.compile(r'\([^)\n]*\)|\[[^\]\n]*\]|\{[^}\n]*\}|<[^>\n]*>')
+_WHITESPACE_RE = re.compile(r'\s+')
 
 def clean_text_for_tts(text: str) -> str:
     """
     تنظيف النص من الرموز التي قد تؤثر على جودة القراءة الصوتية
     """
-    # استبدال علامات الترقيم التي قد تسبب مشاكل بمسافات أو استبعادها
-    text = re.sub(r'!', ' ', text)  # استبدال علامة التعجب بمسافة
-    text = re.sub(r'\?', ' ', text)  # استبدال علامة الاستفهام بمسافة
-    text = re.sub(r'[،,]', ' ', text)  # استبدال الفواصل بمسافات
-    text = re.sub(r';', ' ', text)  # استبدال الفاصلة المنقوطة بمسافة
-    text = re.sub(r':', ' ', text)  # استبدال النقطتين بمسافة
-    text = re.sub(r'#', ' ', text)  # استبدال علامة الهاشتاغ بمسافة
-    text = re.sub(r'@', ' ', text)  # استبدال علامة الإيميل بمسافة
-    text = re.sub(r'_', ' ', text)  # استبدال الشرطة السفلية بمسافة
-    text = re.sub(r'\*', ' ', text)  # استبدال علامة النجمة بمسافة
-    text = re.sub(r'=', ' ', text)  # استبدال علامة المساواة بمسافة
-    text = re.sub(r'\+', ' ', text)  # استبدال علامة الزائد بمسافة
-    text = re.sub(r'-', ' ', text)  # استبدال علامة الناقص بمسافة
-    text = re.sub(r'/', ' ', text)  # استبدال علامة القسمة بمسافة
-    text = re.sub(r'\\', ' ', text)  # استبدال الشرطة المائلة العكسية بمسافة
-    text = re.sub(r'%', ' بالمئة ', text)  # استبدال علامة النسبة بكلمة "بالمئة"
-    text = re.sub(r'&', ' و ', text)  # استبدال علامة & بكلمة "و"
-    text = re.sub(r'\^', ' ', text)  # استبدال علامة القوة بمسافة
-    text = re.sub(r'\$', ' ', text)  # استبدال علامة الدولار بمسافة
-    
-    # إزالة علامات التنصيص تماماً
-    text = re.sub(r'["""\'«»]', ' ', text)  # إزالة كل أنواع علامات التنصيص
+    # استبدال علامات الترقيم وعلامات التنصيص بمسافات أو كلمات مقروءة
+    text = text.translate(_TTS_TRANSLATE)
     
     # إزالة الأقواس والمحتوى بداخلها
-    text = re.sub(r'\(.*?\)', ' ', text)
-    text = re.sub(r'\[.*?\]', ' ', text)
-    text = re.sub(r'\{.*?\}', ' ', text)
-    text = re.sub(r'<.*?>', ' ', text)
+    text = _BRACKETS_RE.sub(' ', text)
     
     # تنظيف الفترات الطويلة من المسافات المتكررة الناتجة عن الإزالة
-    text = re.sub(r'\s+', ' ', text)
+    text = _WHITESPACE_RE.sub(' ', text)
     
     # الحفاظ على النقاط كفواصل بين الجمل مع إضافة مسافة
-    text = re.sub(r'\.', '. ', text)
+    text = text.replace('.', '. ')
     
     return text.strip()
 
-async def ensure_storage_path():
+def ensure_storage_path():
     """
-    التأكد من وجود مجلد لتخزين ملفات الصوت
+    التأكد من وجود مجلد لتخزين ملفات الصوت، يُستدعى مرة واحدة عند تشغيل الخادم
     """
     Path(AUDIO_STORAGE_PATH).mkdir(parents=True, exist_ok=True)
 
-async def text_to_speech(text: str, filename: str) -> str:
+def _split_tts_chunks(text: str) -> List[str]:
+    """
+    تقسيم النص على حدود الجمل إلى أجزاء لا تتجاوز TTS_CHUNK_CHARS تقريباً
+    """
+    sentences = text.split('. ')
+    chunks = []
+    current = ""
+    for i, sentence in enumerate(sentences):
+        if i < len(sentences) - 1:
+            sentence += '.'
+        if current and len(current) + len(sentence) + 1 > TTS_CHUNK_CHARS:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks or [text]
+
+
+def _synthesize_chunk(text: str) -> bytes:
+    """
+    تحويل جزء من النص إلى صوت MP3 في الذاكرة
+    """
+    buffer = BytesIO()
+    gTTS(text=text, lang='ar', slow=False).write_to_fp(buffer)
+    return buffer.getvalue()
+
+
+def _load_local_tts():
     """
-    تحويل النص إلى صوت وحفظه في ملف
+    تحميل نموذج TTS المحلي على GPU إن وُجد
     """
-    # التأكد من وجود مجلد التخزين
-    await ensure_storage_path()
+    import torch
+    from TTS.api import TTS
     
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    return TTS(TTS_MODEL_NAME).to(device)
+
+
+def _run_local_tts_batch(texts: List[str]) -> List[bytes]:
+    """
+    تحويل دفعة من الأجزاء إلى صوت PCM (float32) بالنموذج المحلي
+    """
+    import numpy as np
+    import torch
+    
+    results = []
+    with torch.inference_mode():
+        for text in texts:
+            wav = _local_tts.tts(text=text, language="ar", speaker=TTS_SPEAKER)
+            results.append(np.asarray(wav, dtype=np.float32).tobytes())
+    return results
+
+
+async def _encode_mp3(pcm: bytes) -> bytes:
+    """
+    ترميز صوت PCM إلى MP3 باستخدام ffmpeg حتى يبقى تنسيق الملفات كما هو
+    """
+    sample_rate = _local_tts.synthesizer.output_sample_rate
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, "-loglevel", "error",
+        "-f", "f32le", "-ar", str(sample_rate), "-ac", "1", "-i", "pipe:0",
+        "-f", "mp3", "-write_xing", "0", "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    mp3, stderr = await process.communicate(pcm)
+    
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to encode audio: {stderr.decode(errors='ignore')}")
+    
+    return mp3
+
+
+async def _local_tts_loop():
+    """
+    معالجة طابور الأجزاء على دفعات، نموذج واحد يعمل في خيط واحد في كل مرة
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch: List[Tuple[str, asyncio.Future]] = [await _local_tts_queue.get()]
+        deadline = loop.time() + TTS_BATCH_WINDOW
+        while len(batch) < TTS_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_local_tts_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            results = await loop.run_in_executor(_tts_executor, _run_local_tts_batch, [text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        
+        for (_, future), pcm in zip(batch, results):
+            if not future.done():
+                future.set_result(pcm)
+
+
+async def _synthesize_chunk_locally(text: str) -> bytes:
+    """
+    إرسال جزء إلى طابور النموذج المحلي وانتظار صوته بصيغة MP3
+    """
+    future = asyncio.get_running_loop().create_future()
+    await _local_tts_queue.put((text, future))
+    pcm = await future
+    return await _encode_mp3(pcm)
+
+
+async def start_local_tts() -> None:
+    """
+    تحميل نموذج TTS المحلي عند تشغيل الخادم إذا تم اختياره، مع الرجوع إلى gTTS عند الفشل
+    """
+    global _local_tts, _local_tts_queue, _local_tts_worker
+    
+    if TTS_BACKEND != "xtts":
+        return
+    
+    if FFMPEG_PATH is None:
+        logger.warning("Local TTS needs ffmpeg to encode MP3, falling back to gTTS")
+        return
+    
+    try:
+        _local_tts = await asyncio.to_thread(_load_local_tts)
+    except Exception as e:
+        logger.warning("Failed to load local TTS model %s, falling back to gTTS: %s", TTS_MODEL_NAME, e)
+        return
+    
+    _local_tts_queue = asyncio.Queue(maxsize=TTS_QUEUE_SIZE)
+    _local_tts_worker = asyncio.create_task(_local_tts_loop())
+    logger.info("Local TTS model loaded: %s", TTS_MODEL_NAME)
+
+
+async def stop_local_tts() -> None:
+    """
+    إيقاف معالج طابور النموذج المحلي عند إيقاف الخادم
+    """
+    if _local_tts_worker is not None:
+        _local_tts_worker.cancel()
+
+
+def _write_audio_file(file_path: str, parts: List[bytes], story_id: str, generation: int) -> bool:
+    """
+    دمج أجزاء MP3 في ملف واحد، ثم نقله إلى مكانه دفعة واحدة حتى لا يُقرأ ملف ناقص
+    
+    Returns:
+        False إذا أُبطل صوت القصة أثناء الكتابة، وعندها لا يُنقل الملف
+    """
+    tmp_path = f"{file_path}.part"
+    with open(tmp_path, "wb") as f:
+        # إطارات MP3 مستقلة، فيكفي وصل البايتات كما تفعل gTTS نفسها
+        for part in parts:
+            f.write(part)
+    
+    with _audio_files_lock:
+        if _audio_generation(story_id) != generation:
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, file_path)
+    return True
+
+
+async def iter_audio_file(file_path: str, start: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+    """
+    قراءة ملف صوتي (أو جزء محدد منه) على دفعات دون تحميله كاملاً في الذاكرة
+    """
+    async with aiofiles.open(file_path, "rb") as f:
+        if start:
+            await f.seek(start)
+        while length is None or length > 0:
+            size = AUDIO_CHUNK_SIZE if length is None else min(AUDIO_CHUNK_SIZE, length)
+            chunk = await f.read(size)
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+
+
+async def text_to_speech(text: str, filename: str, story_id: str, generation: int) -> str:
+    """
+    تحويل النص إلى صوت وحفظه في ملف، ما لم يُبطل صوت القصة قبل اكتماله
+    """
     # مسار الملف الكامل
     file_path = os.path.join(AUDIO_STORAGE_PATH, filename)
     
@@ -82,50 +396,388 @@ async def text_to_speech(text: str, filename: str) -> str:
     
     # تنظيف النص من الرموز التي قد تؤثر على جودة القراءة
     cleaned_text = clean_text_for_tts(text)
-    print(f"Original text length: {len(text)}, Cleaned text length: {len(cleaned_text)}")
+    logger.debug("Original text length: %d, Cleaned text length: %d", len(text), len(cleaned_text))
     
-    # استخدام وظيفة run_in_executor لتنفيذ عملية TTS في خيط منفصل
-    loop = asyncio.get_event_loop()
+    # توليد صوت كل جزء بالتوازي ثم دمجها بالترتيب
+    loop = asyncio.get_running_loop()
+    chunks = _split_tts_chunks(cleaned_text)
     
-    await loop.run_in_executor(
-        None,
-        lambda: gTTS(text=cleaned_text, lang='ar', slow=False).save(file_path)
-    )
+    if _local_tts is not None:
+        parts = await asyncio.gather(*(_synthesize_chunk_locally(chunk) for chunk in chunks))
+    else:
+        parts = await asyncio.gather(*(
+            loop.run_in_executor(_tts_executor, _synthesize_chunk, chunk)
+            for chunk in chunks
+        ))
+    
+    written = await loop.run_in_executor(_tts_executor, _write_audio_file, file_path, parts, story_id, generation)
+    if not written:
+        raise asyncio.CancelledError()
     
     return filename
 
+async def _render_speed_variant(filename: str, speed: float, story_id: str, generation: int) -> Optional[str]:
+    """
+    تحضير نسخة من الملف الصوتي بسرعة معينة باستخدام ffmpeg
+    """
+    variant = _variant_filename(filename, speed)
+    variant_path = os.path.join(AUDIO_STORAGE_PATH, variant)
+    tmp_path = f"{variant_path}.part"
+    
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, "-y", "-loglevel", "error",
+        "-i", os.path.join(AUDIO_STORAGE_PATH, filename),
+        "-filter:a", f"atempo={speed}", "-vn", "-f", "mp3", tmp_path,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        # لا يتوقف ffmpeg بإلغاء المهمة التي تنتظره
+        process.kill()
+        raise
+    
+    if process.returncode != 0:
+        logger.warning("ffmpeg failed to render %s at speed %s: %s", filename, speed, stderr.decode(errors="ignore"))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    
+    # لا يوجد انتظار بين الفحص والنقل، فلا يمكن أن يحذف الإبطال الملفات بينهما
+    if _audio_generation(story_id) != generation:
+        os.remove(tmp_path)
+        return None
+    
+    os.replace(tmp_path, variant_path)
+    return variant
+
+
+async def _render_speed_variants(filename: str, story_id: str, generation: int) -> AudioFiles:
+    """
+    تحضير نسخ الملف الصوتي بجميع السرعات المدعومة مرة واحدة عند التوليد
+    """
+    files = {_speed_key(1.0): filename}
+    if FFMPEG_PATH is None:
+        return files
+    
+    speeds = [speed for speed in AUDIO_SPEEDS if speed != 1.0]
+    variants = await asyncio.gather(*(_render_speed_variant(filename, speed, story_id, generation) for speed in speeds))
+    for speed, variant in zip(speeds, variants):
+        if variant is not None:
+            files[_speed_key(speed)] = variant
+    
+    return files
+
+
+def _speed_file(files: AudioFiles, speed: float) -> str:
+    """
+    اختيار الملف المحضر بنفس السرعة المطلوبة تماماً، أو الملف الأصلي لتُضبط سرعته في الواجهة الأمامية
+    """
+    return files.get(_speed_key(speed), files[_speed_key(1.0)])
+
+
+async def _add_speed_variants(story_id: str, filename: str, generation: int) -> None:
+    """
+    تحضير نسخ السرعات المختلفة وإضافتها إلى فهرس القصة ما لم يُبطل صوتها في الأثناء
+    """
+    files = await _render_speed_variants(filename, story_id, generation)
+    if _audio_generation(story_id) != generation:
+        return
+    await audio_index.set(story_id, files)
+
+
+def _on_variant_task_done(story_id: str, task: asyncio.Task) -> None:
+    """
+    إزالة مهمة تحضير نسخ السرعات بعد انتهائها وتسجيل الخطأ إن وجد
+    """
+    if _variant_tasks.get(story_id) is task:
+        del _variant_tasks[story_id]
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Rendering speed variants failed for story %s: %s", story_id, task.exception())
+
+
+async def _register_story_audio(story_id: str, filename: str, generation: int) -> AudioFiles:
+    """
+    تسجيل الملف الأصلي في الفهرس فوراً، ثم تحضير نسخ السرعات في الخلفية
+    
+    حتى تُحضر النسخ تُضبط السرعات الأخرى في الواجهة الأمامية عبر ?speed= على الملف الأصلي
+    """
+    if _audio_generation(story_id) != generation:
+        raise asyncio.CancelledError()
+    
+    files = {_speed_key(1.0): filename}
+    await audio_index.set(story_id, files)
+    
+    if FFMPEG_PATH is not None:
+        task = asyncio.create_task(_add_speed_variants(story_id, filename, generation))
+        _variant_tasks[story_id] = task
+        task.add_done_callback(lambda t: _on_variant_task_done(story_id, t))
+    
+    return files
+
+
+async def _generate_story_audio(story_id: str) -> AudioFiles:
+    """
+    توليد الملف الصوتي للقصة وتسجيله في الفهرس، وتُحضر نسخ السرعات المختلفة في الخلفية
+    """
+    generation = _audio_generation(story_id)
+    
+    # ربما أنهى طلب سابق التوليد بين التحقق من الفهرس وبدء هذه المهمة
+    files = await audio_index.get(story_id)
+    if files is not None:
+        return files
+    
+    # التأكد من وجود عنوان للقصة
+    await generate_title_if_missing(story_id)
+    
+    # الحصول على نص القصة الكامل
+    story_text = await get_complete_story(story_id)
+    
+    # إنشاء اسم فريد للملف الصوتي
+    filename = f"{story_id}_{uuid.uuid4().hex}.mp3"
+    
+    # تحويل النص إلى صوت
+    await text_to_speech(story_text, filename, story_id, generation)
+    
+    return await _register_story_audio(story_id, filename, generation)
+
+
+def _on_audio_task_done(story_id: str, task: asyncio.Task) -> None:
+    """
+    إزالة مهمة توليد الصوت بعد انتهائها وتسجيل الخطأ إن وجد
+    """
+    # قد تكون مهمة أحدث قد سُجلت بعد إلغاء هذه المهمة
+    if _audio_tasks.get(story_id) is task:
+        del _audio_tasks[story_id]
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Audio generation failed for story %s: %s", story_id, task.exception())
+
+
 async def generate_audio_for_story(story_id: str, speed: float = 1.0) -> str:
     """
-    توليد ملف صوتي للقصة الكاملة وإرجاع معرف الملف مع معلومات السرعة
+    توليد ملف صوتي للقصة الكاملة وإرجاع اسم الملف المناسب للسرعة المطلوبة
     """
+    await _check_story_exists(story_id)
+    
     # التحقق مما إذا كان هناك ملف صوتي موجود للقصة
-    if story_id not in story_audio_files:
-        # التأكد من وجود عنوان للقصة
-        await generate_title_if_missing(story_id)
-        
-        # الحصول على نص القصة الكامل
-        story_text = await get_complete_story(story_id)
+    files = await audio_index.get(story_id)
+    if files is None:
+        # لا يوجد انتظار بين البحث عن المهمة وتسجيلها، فلا حاجة إلى قفل
+        task = _audio_tasks.get(story_id)
+        if task is None:
+            task = asyncio.create_task(_generate_story_audio(story_id))
+            _audio_tasks[story_id] = task
+            task.add_done_callback(lambda t: _on_audio_task_done(story_id, t))
         
-        # إنشاء اسم فريد للملف الصوتي
-        filename = f"{story_id}_{uuid.uuid4().hex}.mp3"
-        
-        # تحويل النص إلى صوت
-        await text_to_speech(story_text, filename)
+        # إلغاء طلب أحد المستخدمين لا يلغي التوليد للآخرين
+        # وإذا كان التوليد بثاً جارياً نُسجل كمستمع حتى لا يُوقف عند انصراف مستمعي البث
+        stream = _audio_streams.get(story_id)
+        if stream is not None:
+            stream.acquire()
+        try:
+            files = await asyncio.shield(task)
+        finally:
+            if stream is not None:
+                stream.release()
+    
+    return _speed_file(files, speed)
+
+class _AudioStream:
+    """Fans one in-progress gTTS synthesis out to every listener, replaying chunks already produced"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.listeners = 0
+        self.task: Optional[asyncio.Task] = None
+        # يُفحص في خيط gTTS بين الأجزاء لإيقافه عند انصراف جميع المستمعين
+        self.stop = threading.Event()
+        self._waiters: List[asyncio.Future] = []
+
+    def _notify(self) -> None:
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    def append(self, chunk: bytes) -> None:
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def abort(self) -> None:
+        self.stop.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    def acquire(self) -> None:
+        self.listeners += 1
+
+    def release(self) -> None:
+        self.listeners -= 1
+        # لا فائدة من إكمال التوليد إذا لم يعد أحد ينتظره
+        if self.listeners == 0 and not self.done:
+            self.abort()
+
+    def subscribe(self) -> AsyncIterator[bytes]:
+        # يُسجل المستمع فوراً وليس عند أول قراءة، حتى لا يُلغى التوليد قبل بدء الاستجابة
+        self.acquire()
+        return self._iter_chunks()
+
+    async def _iter_chunks(self) -> AsyncIterator[bytes]:
+        try:
+            i = 0
+            while True:
+                if i < len(self.chunks):
+                    yield self.chunks[i]
+                    i += 1
+                elif self.done:
+                    if self.error is not None:
+                        raise RuntimeError("توقف توليد الصوت قبل اكتماله")
+                    return
+                else:
+                    waiter = asyncio.get_running_loop().create_future()
+                    self._waiters.append(waiter)
+                    await waiter
+        finally:
+            self.release()
+
+
+# البث الجاري لكل قصة، مسجل أيضاً في _audio_tasks كمهمة توليد عادية
+_audio_streams: Dict[str, _AudioStream] = {}
+
+
+def _produce_gtts_stream(loop: asyncio.AbstractEventLoop, stream: _AudioStream, text: str) -> None:
+    """
+    تشغيل gTTS في خيط منفصل وإرسال أجزاء MP3 إلى البث فور وصولها
+    """
+    for chunk in gTTS(text=text, lang='ar', slow=False).stream():
+        if stream.stop.is_set():
+            return
+        loop.call_soon_threadsafe(stream.append, chunk)
+
+
+async def _run_audio_stream(story_id: str, text: str, stream: _AudioStream) -> AudioFiles:
+    """
+    تشغيل البث حتى نهايته ثم حفظ الصوت على القرص وتسجيله حتى تستفيد منه الطلبات اللاحقة
+    """
+    loop = asyncio.get_running_loop()
+    generation = _audio_generation(story_id)
+    try:
+        await loop.run_in_executor(_tts_executor, _produce_gtts_stream, loop, stream, text)
+    except BaseException as e:
+        stream.stop.set()
+        stream.finish(e)
+        raise
+    if stream.stop.is_set():
+        raise asyncio.CancelledError()
+    stream.finish()
+    
+    filename = f"{story_id}_{uuid.uuid4().hex}.mp3"
+    file_path = os.path.join(AUDIO_STORAGE_PATH, filename)
+    if not await loop.run_in_executor(_tts_executor, _write_audio_file, file_path, stream.chunks, story_id, generation):
+        raise asyncio.CancelledError()
+    
+    return await _register_story_audio(story_id, filename, generation)
+
+
+def _on_audio_stream_done(story_id: str, stream: _AudioStream) -> None:
+    """
+    إيقاظ المستمعين إذا انتهى البث دون اكتمال (حتى لو أُلغيت المهمة قبل أن تبدأ) وإزالة تسجيله
+    """
+    if not stream.done:
+        stream.finish(asyncio.CancelledError())
+    if _audio_streams.get(story_id) is stream:
+        del _audio_streams[story_id]
+
+
+def _start_audio_stream(story_id: str, text: str) -> _AudioStream:
+    """
+    بدء بث جديد وتسجيله قبل أول جزء، حتى تنضم إليه الطلبات المتزامنة بدلاً من تكرار التوليد
+    """
+    stream = _AudioStream()
+    stream.task = asyncio.create_task(_run_audio_stream(story_id, text, stream))
+    _audio_streams[story_id] = stream
+    _audio_tasks[story_id] = stream.task
+    stream.task.add_done_callback(lambda t: _on_audio_task_done(story_id, t))
+    stream.task.add_done_callback(lambda t: _on_audio_stream_done(story_id, stream))
+    return stream
+
+
+async def stream_audio_for_story(story_id: str) -> AsyncIterator[bytes]:
+    """
+    الحصول على مولد يبث صوت القصة، من الملف إن وُجد أو من gTTS أثناء التوليد
+    
+    يتم التحقق من القصة قبل إرجاع المولد حتى تظهر الأخطاء قبل بدء الاستجابة
+    """
+    await _check_story_exists(story_id)
+    
+    files = await audio_index.get(story_id)
+    
+    if files is None:
+        stream = _audio_streams.get(story_id)
+        if stream is not None:
+            return stream.subscribe()
         
-        # تخزين معرف الملف الصوتي للقصة
-        story_audio_files[story_id] = filename
+        if _local_tts is not None or story_id in _audio_tasks:
+            # النموذج المحلي لا يبث أجزاءه، والتوليد الجاري يكفي انتظاره
+            await generate_audio_for_story(story_id)
+            files = await audio_index.get(story_id)
     
-    # إضافة معلومات السرعة للملف (سيتم استخدامها في الواجهة الأمامية)
-    # وذلك حتى نتجنب الحاجة إلى معالجة ملفات الصوت مباشرةً
-    filename = story_audio_files[story_id]
+    if files is not None:
+        return iter_audio_file(os.path.join(AUDIO_STORAGE_PATH, files[_speed_key(1.0)]))
     
-    return filename
+    await generate_title_if_missing(story_id)
+    story_text = await get_complete_story(story_id)
+    
+    # ربما بدأ طلب آخر التوليد أثناء تحميل القصة
+    stream = _audio_streams.get(story_id)
+    if stream is None:
+        if story_id in _audio_tasks:
+            await generate_audio_for_story(story_id)
+            files = await audio_index.get(story_id)
+            return iter_audio_file(os.path.join(AUDIO_STORAGE_PATH, files[_speed_key(1.0)]))
+        stream = _start_audio_stream(story_id, clean_text_for_tts(story_text))
+    
+    return stream.subscribe()
+
+
+async def invalidate_story_audio(story_id: str) -> None:
+    """
+    إزالة صوت القصة من الفهرس ومن القرص بعد تعديلها أو حذفها، حتى لا يُقدم صوت قديم
+    """
+    # التوليد الجاري يعتمد على النص القديم، ويُغير الجيل قبل الحذف حتى لا تُنقل ملفاته بعده
+    _audio_generations[story_id] = _audio_generation(story_id) + 1
+    stream = _audio_streams.pop(story_id, None)
+    if stream is not None:
+        stream.abort()
+    task = _audio_tasks.pop(story_id, None)
+    if task is not None:
+        task.cancel()
+    task = _variant_tasks.pop(story_id, None)
+    if task is not None:
+        task.cancel()
+    
+    await audio_index.delete(story_id)
+    await asyncio.to_thread(_remove_audio_files, story_id)
+
 
 def get_audio_url(filename: str, speed: float = 1.0) -> str:
     """
     الحصول على رابط الملف الصوتي مع معلومات السرعة
     """
-    base_url = f"{BASE_URL}/audio/{filename}"
+    # مسار الـ API يدعم طلبات Range وترويسات التخزين المؤقت و X-Accel-Redirect
+    base_url = f"{BASE_URL}/api/stories/audio/{filename}"
+    
+    # النسخ المحضرة مسبقاً تُشغل كما هي، فيبقى رابطها ثابتاً وقابلاً للتخزين المؤقت
+    if "@" in filename:
+        return base_url
     
     # إضافة معامل سرعة التشغيل كمعامل استعلام
     # سيتم استخدامه في الواجهة الأمامية لضبط سرعة التشغيل